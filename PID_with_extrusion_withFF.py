@@ -1,18 +1,25 @@
 from asyncio import sleep
+import os
 import time
 from cv2 import repeat
 import serial
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 import utils
+import transport
+from telemetry import TelemetryStore
+from live_plot import LiveRenderer, start_timer
+from control_loop import ControlLoop
+from run_archive import RunWriter
+from smoothing import Chain, OutlierFilter, RunningMean
+from feedforward import decaying_step_ff
 
 
-com = "COM6"
+com = os.environ.get("PRINTER_PORT", "COM6")  # e.g. the pty printed by simulator.py
 figname = f"./PID_tests/EXTRUDE_FF_k0_{time.time()}"
 
 # Connect to printer
-ser = utils.get_serial_connection(port=com, baudrate=38400)
+ser = transport.get_serial_transport(port=com, baudrate=38400)
 
 # Define initial parameters
 max_start_temp = 25
@@ -28,6 +35,12 @@ time.sleep(2)
 timestep = 0.5 # seconds
 max_timesteps = 60*10 # seconds
 avg_pts = 10  # Number of points for moving average
+plot_interval = 1.0  # seconds between plot refreshes
+
+# Feedforward disturbance model of the extrusion
+dist_K = 0
+dist_tau = 2
+dist_T = 50
 
 
 # Setup figure
@@ -41,25 +54,32 @@ extrude_line, = ax.plot([],[], label="Feed Rate")
 
 # extr_avg_text = plt.figtext(0.1, 0.5, f"{avg_pts} Moving Average: ", fontsize=14)
 textstr = f"{avg_pts} point Avg"
+# Missed readings (NaN) and spikes are rejected before averaging, RunningMean skips any NaN left
+temp_avg = Chain(OutlierFilter(), RunningMean(avg_pts))
 extr_avg_text = plt.gcf().text(0.77, 0.5, textstr, fontsize=12)
 
 ax.set_ylabel("Nozzle Temp")
 ax.set_xlabel('Time')
 ax.legend(bbox_to_anchor=(1.04,1), loc="upper left")
+renderer = LiveRenderer(ax, [line, target_line, extrude_line], extra_artists=[extr_avg_text])
 
-nozzle_temp_data = np.array([])
-time_data = np.array([])
-temp_target_data = np.array([])
-extrude_data = np.array([])
+data = TelemetryStore(['times', 'temp', 'temp_target', 'extrude'])
+# Samples are also flushed to a run archive as they come in
+archive = RunWriter(f"{figname}.run", columns=data.columns,
+                    metadata=dict(kp=kp, ki=ki, kd=kd, timestep=timestep, temp_target=temp_target,
+                                  dist_K=dist_K, dist_tau=dist_tau, dist_T=dist_T))
 
 # Set extrusion type as absolute
 ser.write(f"M83\r\n".encode())
 
+# Each tick's commands go out in one write, unchanged setpoints are not resent
+batch = transport.CommandBatcher(ser)
+
 extrude_phase = 0
 extrude_feedrate = 350
 def extrude_update():
   """Function to send targets"""
-  global extrude_data, extrude_phase
+  global extrude_phase
   while True:
     # Phase 0: Preheat nozzle to 200 (see default case)
 
@@ -67,105 +87,86 @@ def extrude_update():
     if extrude_phase == 1:
       feed_rate = 360 # mm/min
       extrude_amount = int(feed_rate * timestep / 60)
-      ser.write(f"G1 F{feed_rate} E{extrude_amount}\r\n".encode())
+      batch.write(f"G1 F{feed_rate} E{extrude_amount}\r\n".encode())
       yield feed_rate
-      # extrude_data = np.append(extrude_data, [feed_rate])
     
     # Default phase: Extrude 0
     else:
       extrude_phase = 0 # Reset extrude phase
-      ser.write(f"G1 F{extrude_feedrate} E0\r\n".encode())
+      batch.write(f"G1 F{extrude_feedrate} E0\r\n".encode())
       yield 0
 extrude_update_gen = extrude_update()
 
-temp_target_update = 0 # Store update temperature
+# FF filter: O(1) per tick, for any feed rate profile
+feedforward = decaying_step_ff(dist_K, dist_tau, dist_T, timestep, feedrate_ref=extrude_feedrate)
 def temp_target_update():
   """Generator to send target temperature"""
-
-  dist_K = 0
-  dist_tau = 2
-  dist_T = 50
-
-  global axis_start_time
   while True:
-    # Phase 0: No Extrusion
-
-    # Phase 1: Extrusion
+    # Offset from this tick's feed rate (zero until extrusion starts)
+    temp_update = feedforward.step(data['extrude'][-1])
     if extrude_phase == 1:
-      start_idx = start_idx if start_idx else len(time_data) - 1
-      curr_idx = len(time_data) - 1
-      t = (curr_idx - start_idx) * timestep
-      temp_update = dist_K * extrude_data[int(curr_idx - dist_tau / timestep)] * np.exp(- t / dist_T ) / extrude_feedrate
       print(temp_update)
-    # Other phase
-    else:
-      temp_update = 0
-      start_idx = 0
-      
-    ser.write(f"M104 S{temp_update + temp_target}\r\n".encode())
+
+    batch.write(f"M104 S{temp_update + temp_target}\r\n".encode())
     yield temp_update + temp_target
 temp_target_update_gen = temp_target_update()
 
 rescale_flag = False
 axis_start_time = 0
-def update(i):
-  global nozzle_temp_data, time_data, extrude_data, axis_start_time, temp_target_data
+def update(i, t):
+  """Control tick, run every timestep on the control loop thread"""
+  global temp_request
 
   # Read temperature measurement
   # NOTE: This measurement lags behind by 0.5s (i.e. update interval)
-  nozzle_temp_data = np.append(nozzle_temp_data, [utils.extract_nozzle_temp(ser)])
-  time_data = np.append(time_data, [len(time_data) * timestep])
-  extrude_data = np.append(extrude_data, [next(extrude_update_gen)])
-  temp_target_data = np.append(temp_target_data, [next(temp_target_update_gen)])
+  nozzle_temp = transport.wait_result(temp_request, timeout=timestep)
+  data.append(times=t, temp=np.nan if nozzle_temp is None else nozzle_temp,
+              extrude=next(extrude_update_gen))
+  # The FF law reads this row's extrusion, so the target is filled in after
+  data.set_last('temp_target', next(temp_target_update_gen))
+  archive.append_last(data)
+  temp_avg.step(data['temp'][-1])
 
-  # Replot line
-  line.set_data(time_data, nozzle_temp_data)
-  target_line.set_data(time_data, temp_target_data)
-  extrude_line.set_data(time_data, extrude_data)
+  # Send command to printer to measure temperature
+  temp_request = batch.request_nozzle_temp()
+  batch.flush()
+
+def redraw(i):
+  """Replot lines from the data recorded so far"""
+  times, temp, temp_target_data, extrude = data.views('times', 'temp', 'temp_target', 'extrude')
 
   # Plot moving average
-  avg_temp = np.mean(nozzle_temp_data[-avg_pts:])
+  avg_temp = temp_avg.value
   extr_avg_text.set_text(f"{textstr}\n{avg_temp:.2f}")
   # extr_avg_text.set_position((1.04, 0.5))
 
-  # Rescale axis to show close up view of data
-  if rescale_flag:
-    # axis_start_time = time_data[-1] if axis_start_time == 0 else axis_start_time
-    ax.set_xlim(axis_start_time, time_data[-1])
-    ax.set_ylim(temp_target - 5, temp_target + 5)
-  else:
-    ax.autoscale()
-
-  ax.relim()
-  ax.autoscale_view()
-
-  # Send command to printer to measure temperature
-  ser.write(b'M105\r\n')
+  # Replot line
+  renderer.refresh(times, [temp, temp_target_data, extrude])
     
 # Heat up nozzle to desired temperature
 # NOTE: MAY want to visualise this to check
 # if temperature has truly settled
-# utils.set_nozzle_temp(ser, temp=temp_target, avg_num=10, tol=0.5)
+# settle.set_nozzle_temp(ser, temp=temp_target, avg_num=10, tol=0.5)
 
 # Set desired temperature
 ser.write(f"M104 S{temp_target}\r\n".encode())
 
 # Request temperature measurement
-ser.write(b'M105\r\n')
-ani = animation.FuncAnimation(fig, update, interval=int(timestep*1000), frames=int(max_timesteps/timestep), repeat=False)
+temp_request = ser.request_nozzle_temp()
+loop = ControlLoop(update, timestep, max_ticks=int(max_timesteps/timestep)).start()
+timer = start_timer(fig, redraw, interval=int(plot_interval*1000))
 
 def save_fig(event):
   global extrude_phase, rescale_flag, axis_start_time
   if event.key == 's':
-    ani.event_source.stop()
+    loop.stop()
+    timer.stop()
     # fig.savefig('test.png')
     plt.savefig(f"{figname}_graph.pdf")
     print(f"Saved fig at: {figname}.pdf")
 
-    np.save(f"{figname}_temp", nozzle_temp_data)
-    np.save(f"{figname}_times", time_data)
-    np.save(f"{figname}_extrude", extrude_data)
-    np.save(f"{figname}_temp_target", temp_target_data)
+    data.save(figname)
+    archive.close()
 
     utils.close_printer(ser)
   
@@ -175,7 +176,12 @@ def save_fig(event):
 
   if event.key == 'r':
     rescale_flag = not rescale_flag
-    axis_start_time = time_data[-1] if rescale_flag else 0
+    # Close up view of the data from now on
+    axis_start_time = data['times'][-1] if rescale_flag else 0
+    if rescale_flag:
+      renderer.set_view(xmin=axis_start_time, ylim=(temp_target - 5, temp_target + 5))
+    else:
+      renderer.set_view()
     print(f"Rescaling axis")
 
 cid = fig.canvas.mpl_connect('key_press_event', save_fig)
@@ -183,5 +189,9 @@ cid = fig.canvas.mpl_connect('key_press_event', save_fig)
 plt.show()
 
 # Closing script
+loop.stop()
+archive.close()
+print(f"Control loop timing: {loop.jitter_summary()}")
+print(f"Commands: {dict(batch.stats)}")
 utils.close_printer(ser)
 
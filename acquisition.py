@@ -0,0 +1,102 @@
+# Temperature acquisition: firmware auto-reports (M155) or M105 polling
+import math
+import threading
+import time
+import temp_reports
+import transport
+from control_loop import ControlLoop
+
+AUTOREPORT_CAP = 'Cap:AUTOREPORT_TEMP:1'  # M115 line of firmware with M155
+
+
+def supports_autoreport(ser, timeout=2.0):
+  """Ask the firmware (M115) whether it can push temperature reports (M155)"""
+  lines = transport.wait_result(ser.send('M115'), timeout, default=[])
+  return any(line.strip() == AUTOREPORT_CAP for line in lines)
+
+
+class TemperatureFeed:
+  """Time-stamped temperature reports, pushed by the firmware or polled
+
+  mode 'auto' turns on Marlin's auto-report (M155) if M115 says the
+  firmware has it, and falls back to sending M105 every `interval` s
+  otherwise; 'push' and 'poll' force either. Pushed reports cost no
+  commands and no round trip, and arrive at the firmware's own pace.
+  Marlin takes the M155 interval in whole seconds, so 'auto' polls for
+  intervals under 1 s and 'push' rounds `interval` up (see `interval`
+  after `start`).
+
+  Every report received (M105 replies sent by other code included) is
+  stamped with the monotonic time since `start` and passed to
+  `callback(t, report)` on the transport's reader thread.
+  """
+
+  def __init__(self, ser: transport.SerialTransport, interval=1.0, mode='auto', callback=None):
+    self.ser = ser
+    self.interval = interval
+    self.mode = mode
+    self.callback = callback
+    self.push = None
+    self.count = 0
+    self.latest = None  # (t, TemperatureReport)
+    self.started = None
+    self.stopped = False
+    self._poller = None
+    self._request = None
+    self._condition = threading.Condition()
+
+  def start(self):
+    self.push = self.mode == 'push' or (self.mode == 'auto' and self.interval >= 1
+                                        and supports_autoreport(self.ser))
+    self.started = time.monotonic()
+    self.stopped = False
+    self.ser.add_listener(self._on_line)
+    if self.push:
+      self.interval = max(1, math.ceil(self.interval))
+      self.ser.send(f"M155 S{self.interval}")
+    else:
+      self._poller = ControlLoop(self._poll, self.interval).start()
+    print(f"Temperature acquisition: {'M155 auto-report' if self.push else 'M105 polling'} every {self.interval}s")
+    return self
+
+  def stop(self):
+    """Stop the reports; safe to call again, also after the transport is closed"""
+    with self._condition:  # The callback may stop the feed on the reader thread
+      if self.stopped:
+        return
+      self.stopped = True
+    if self.push:
+      if self.ser.is_open:
+        self.ser.send("M155 S0")
+    elif self._poller is not None:
+      self._poller.stop()
+    try:
+      self.ser.remove_listener(self._on_line)
+    except ValueError:
+      pass  # Already stopped
+
+  def wait_next(self, timeout=None):
+    """Block until the next report arrives, returns (t, report) or None on timeout"""
+    with self._condition:
+      count = self.count
+      if not self._condition.wait_for(lambda: self.count > count, timeout):
+        return None
+      return self.latest
+
+  def _poll(self, i, t):
+    # A printer that has not answered the last M105 yet gets no second one
+    if self._request is None or self._request.done():
+      self._request = self.ser.send('M105')
+
+  def _on_line(self, line):
+    t = time.monotonic() - self.started
+    event = temp_reports.parse_report(line.encode())
+    if isinstance(event, temp_reports.TemperatureReport):
+      with self._condition:
+        self.latest = (t, event)
+        self.count += 1
+        self._condition.notify_all()
+      if self.callback is not None:
+        self.callback(t, event)
+    elif event is not None:
+      print(f"Temperature acquisition: {event}")
@@ -0,0 +1,198 @@
+# Animated comparison of catalogued runs, rendered in parallel and streamed to a GIF/MP4
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from run_catalog import RunCatalog, parse_run_name
+from run_metrics import run_inputs
+
+CACHE_DIR = '.animations'  # Rendered frame chunks, inside the catalog directory
+
+
+def comparison_traces(catalog, names, align_step=False, error=False):
+  """(label, times, values) of each run: times from its extrusion step if align_step, values minus target if error"""
+  traces = []
+  for name in names:
+    times, temp, target, step_idx = run_inputs(catalog.load(name), catalog[name]['metadata'])
+    if align_step and step_idx >= 0:
+      times = times - times[step_idx]
+    values = temp - target if error else temp
+    finite = np.isfinite(values)
+    label = name.rsplit('_', 1)[0] if parse_run_name(name)['timestamp'] is not None else name
+    traces.append((label, np.ascontiguousarray(times[finite]), np.ascontiguousarray(values[finite])))
+  return traces
+
+
+def view_limits(traces, margin=0.05, clip=None):
+  """Fixed axes limits covering every trace, so frames do not depend on each other
+
+  clip: percent of the values to leave out at each end (e.g. 0.5 to ignore the odd spike)
+  """
+  times = np.concatenate([t for _, t, _ in traces])
+  values = np.concatenate([v for _, _, v in traces])
+  low, high = np.percentile(values, [clip, 100 - clip]) if clip else (values.min(), values.max())
+  pad = (high - low) * margin or 1.0
+  return (float(times.min()), float(times.max())), (float(low - pad), float(high + pad))
+
+
+def frame_times(traces, fps, speed):
+  """Data time shown by each frame: `speed` data seconds per video second"""
+  (start, end), _ = view_limits(traces)
+  return start + np.arange(int(np.ceil((end - start) * fps / speed)) + 1) * speed / fps
+
+
+def _render_chunk(job):
+  """Render frames [first, last) into a compressed cache file, returns its path
+
+  Frames are drawn incrementally: the axes, legend and labels (all outside
+  the plot area) are drawn once, then only the part of each trace that is
+  new since the previous frame is blitted on top, so a frame costs in
+  proportion to the data it adds.
+  """
+  path = job['path']
+  if os.path.exists(path) and not job['overwrite']:
+    return path
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  from matplotlib.figure import Figure
+  width, height = job['size']
+  fig = Figure(figsize=(width / job['dpi'], height / job['dpi']), dpi=job['dpi'])
+  canvas = FigureCanvasAgg(fig)
+  ax = fig.add_subplot()
+  fig.subplots_adjust(top=0.9 if job['title'] else 0.95, bottom=0.18 + 0.05 * len(job['traces']))
+  ax.set_xlim(*job['xlim'])
+  ax.set_ylim(*job['ylim'])
+  ax.set_xlabel(job['xlabel'])
+  ax.set_ylabel(job['ylabel'])
+  job['title'] and ax.set_title(job['title'])
+  job['reference'] is not None and ax.axhline(job['reference'], color='gray', linestyle='--', linewidth=1)
+  lines = [ax.plot([], [], label=label, linewidth=1.5)[0] for label, _, _ in job['traces']]
+  fig.legend(loc='lower left', fontsize='small', frameon=False)
+  clock = fig.text(0.98, 0.02, f"t = {-max(map(abs, job['xlim'])):.0f} s", ha='right', va='bottom')
+  clock_box = clock.get_window_extent(canvas.get_renderer()).expanded(1.2, 1.2)  # Room for the widest time
+  clock.set_text('')
+  canvas.draw()
+  clock_background = canvas.copy_from_bbox(clock_box)
+
+  times = job['times']
+  drawn = [0] * len(lines)  # Points of each trace drawn so far
+  frames = np.empty((len(times), height, width, 3), dtype=np.uint8)
+  for k, now in enumerate(times):
+    for i, (line, (_, t, v)) in enumerate(zip(lines, job['traces'])):
+      end = int(np.searchsorted(t, now, side='right'))
+      if end > drawn[i]:
+        start = max(drawn[i] - 1, 0)  # Overlap one point so the segments join up
+        line.set_data(t[start:end], v[start:end])
+        ax.draw_artist(line)
+        drawn[i] = end
+    canvas.restore_region(clock_background)
+    clock.set_text(f"t = {now:.0f} s")
+    fig.draw_artist(clock)
+    frames[k] = np.asarray(canvas.buffer_rgba())[..., :3]
+  # Write then rename, so an interrupted render never leaves a truncated chunk in the cache
+  partial = f"{path}.{os.getpid()}.tmp"
+  with open(partial, 'wb') as file:
+    np.savez_compressed(file, frames=frames)
+  os.replace(partial, path)
+  return path
+
+
+def render_frames(traces, output_key, cache_dir, fps=15, speed=20.0, size=(640, 400), dpi=100,
+                  xlabel='Time / s', ylabel='Nozzle Temp / C', title=None, reference=None,
+                  clip=None, chunk=25, processes=None, overwrite=False):
+  """Frames (height x width x 3 uint8) of the animation, in order, rendered `chunk` at a time in a process pool
+
+  The y axis covers every value, or leaves out `clip` percent at each end
+  (see view_limits). Chunks are cached in cache_dir under a hash of the
+  traces and options (`output_key` adds anything else the caller wants in it).
+  """
+  times = frame_times(traces, fps, speed)
+  xlim, ylim = view_limits(traces, clip=clip)
+  options = dict(fps=fps, speed=speed, size=list(size), dpi=dpi, xlabel=xlabel, ylabel=ylabel, title=title,
+                 reference=reference, clip=clip, chunk=chunk, key=output_key)
+  digest = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+  for label, t, v in traces:
+    digest.update(label.encode())
+    digest.update(t.tobytes())
+    digest.update(v.tobytes())
+  key = digest.hexdigest()[:16]
+  os.makedirs(cache_dir, exist_ok=True)
+  jobs = []
+  for first in range(0, len(times), chunk):
+    # Each job redraws the traces up to its first frame, then carries on incrementally
+    jobs.append(dict(path=os.path.join(cache_dir, f"{key}_{first // chunk:05d}.npz"), overwrite=overwrite,
+                     traces=traces, times=times[first:first + chunk], xlim=xlim, ylim=ylim, size=size,
+                     dpi=dpi, xlabel=xlabel, ylabel=ylabel, title=title, reference=reference))
+  with ProcessPoolExecutor(processes) as executor:
+    # map yields in order as chunks finish, so encoding starts before rendering is done
+    for path in executor.map(_render_chunk, jobs):
+      with np.load(path) as data:
+        yield from data['frames']
+
+
+def encode(frames, output, fps):
+  """Write frames to output as they come: MP4 (or anything ffmpeg knows) through an ffmpeg pipe, GIF with Pillow"""
+  if output.lower().endswith('.gif') and shutil.which('ffmpeg') is None:
+    from PIL import Image
+    # Pillow keeps the (palette) frames until the end, ffmpeg does not
+    images = (Image.fromarray(frame).quantize(colors=64, method=Image.Quantize.FASTOCTREE) for frame in frames)
+    first = next(images)
+    first.save(output, save_all=True, append_images=images, duration=int(round(1000 / fps)), loop=0, optimize=False)
+    return output
+  if shutil.which('ffmpeg') is None:
+    raise RuntimeError(f"ffmpeg is needed to write {output} (GIFs can be written without it)")
+  frames = iter(frames)
+  first = next(frames)
+  height, width, _ = first.shape
+  command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{width}x{height}",
+             '-r', str(fps), '-i', '-']
+  if not output.lower().endswith('.gif'):
+    command += ['-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+  process = subprocess.Popen(command + [output], stdin=subprocess.PIPE)
+  try:
+    process.stdin.write(first.tobytes())
+    for frame in frames:
+      process.stdin.write(frame.tobytes())
+  finally:
+    process.stdin.close()
+  if process.wait() != 0:
+    raise RuntimeError(f"ffmpeg failed writing {output}")
+  return output
+
+
+def export(catalog, names, output, align_step=False, error=False, fps=15, speed=20.0, **options):
+  """Render and encode an animation comparing the named runs; returns the output path"""
+  traces = comparison_traces(catalog, names, align_step=align_step, error=error)
+  options.setdefault('ylabel', 'Nozzle Temp Error / C' if error else 'Nozzle Temp / C')
+  options.setdefault('xlabel', 'Time from extrusion step / s' if align_step else 'Time / s')
+  options.setdefault('reference', 0.0 if error else None)
+  frames = render_frames(traces, dict(align_step=align_step, error=error),
+                         os.path.join(catalog.directory, CACHE_DIR), fps=fps, speed=speed, **options)
+  return encode(frames, output, fps)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Animated comparison of runs, e.g. FF vs no FF")
+  parser.add_argument("names", nargs='+', help="run names, as listed by run_catalog.py")
+  parser.add_argument("-o", "--output", default="comparison.gif", help=".gif or .mp4")
+  parser.add_argument("--directory", default="PID_tests")
+  parser.add_argument("--align-step", action="store_true", help="time from the extrusion step")
+  parser.add_argument("--error", action="store_true", help="plot temperature minus target")
+  parser.add_argument("--fps", type=int, default=15)
+  parser.add_argument("--speed", type=float, default=20.0, help="data seconds per video second")
+  parser.add_argument("--size", type=int, nargs=2, default=(640, 400), metavar=("WIDTH", "HEIGHT"))
+  parser.add_argument("--title")
+  parser.add_argument("--clip", type=float, metavar="PERCENT",
+                      help="leave this percent of the values out of the y range at each end (spikes)")
+  parser.add_argument("--processes", type=int, default=None)
+  parser.add_argument("--overwrite", action="store_true", help="re-render cached frames")
+  args = parser.parse_args()
+
+  catalog = RunCatalog(args.directory)
+  catalog.scan()
+  print(export(catalog, args.names, args.output, align_step=args.align_step, error=args.error, fps=args.fps,
+               speed=args.speed, size=tuple(args.size), title=args.title, clip=args.clip,
+               processes=args.processes, overwrite=args.overwrite))
@@ -0,0 +1,86 @@
+# Fixed-period acquisition/control loop
+import threading
+import time
+import traceback
+import numpy as np
+from telemetry import TelemetryStore
+
+
+class ControlLoop:
+  """Calls `tick(i, t)` every `period` seconds on a dedicated thread
+
+  Deadlines are fixed at start + i * period, so lateness does not
+  accumulate. A tick that overruns the next deadline is followed straight
+  away by a late tick; deadlines more than a period gone are skipped rather
+  than run back to back. `t` is the measured monotonic time since the loop
+  started, not i * period.
+
+  The lateness of each tick is kept for the last `history` ticks, see
+  `jitter_summary`. Exceptions in `tick` are printed and the loop carries on.
+  """
+
+  def __init__(self, tick, period, max_ticks=None, history=10000, clock=time.monotonic):
+    self.tick = tick
+    self.period = period
+    self.max_ticks = max_ticks
+    self.clock = clock
+    self.timing = TelemetryStore(['deadline', 'start', 'lateness', 'duration'], window=history)
+    self.ticks = 0
+    self.skipped = 0
+    self.errors = 0
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="control-loop", daemon=True)
+
+  @property
+  def running(self):
+    return self._thread.is_alive()
+
+  def start(self):
+    self._thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    """Stop after the current tick"""
+    self._stop.set()
+    if threading.current_thread() is not self._thread:
+      self._thread.join(timeout)
+
+  def join(self, timeout=None):
+    self._thread.join(timeout)
+
+  def _run(self):
+    start = self.clock()
+    deadline_idx = 0
+    while not self._stop.is_set():
+      if self.max_ticks is not None and self.ticks >= self.max_ticks:
+        break
+      deadline = start + deadline_idx * self.period
+      delay = deadline - self.clock()
+      if delay > 0 and self._stop.wait(delay):
+        break
+      now = self.clock()
+      try:
+        self.tick(self.ticks, now - start)
+      except Exception:
+        self.errors += 1
+        traceback.print_exc()
+      end = self.clock()
+      self.timing.append(deadline=deadline - start, start=now - start,
+                         lateness=now - deadline, duration=end - now)
+      self.ticks += 1
+      # Run a late tick straight away, but skip deadlines that are a whole period gone
+      next_idx = deadline_idx + 1
+      missed = int((end - start) / self.period) - next_idx
+      if missed > 0:
+        self.skipped += missed
+        next_idx += missed
+      deadline_idx = next_idx
+
+  def jitter_summary(self):
+    """Statistics of tick lateness and duration over the recorded history / s"""
+    lateness, duration = self.timing.views('lateness', 'duration')
+    if not len(lateness):
+      return {}
+    return dict(ticks=self.ticks, skipped=self.skipped, errors=self.errors,
+                mean_lateness=float(np.mean(lateness)), max_lateness=float(np.max(lateness)),
+                std_lateness=float(np.std(lateness)), max_duration=float(np.max(duration)))
@@ -1,7 +1,8 @@
 import numpy as np
-from ProcessCommands import processgcode  # This function edits the gcode
+from ProcessCommands import load_commands, processgcode  # This function edits the gcode
 
-printcommands = np.load('objectdata/HollowCube.npy')  # The hollow cube is chosen for processing
+printcommands = load_commands('objectdata/HollowCube.npy')  # The hollow cube is chosen for processing
+# The array is memory-mapped and the gcode is written a chunk at a time, so memory use stays flat for large prints
 
 # See the instruction document for details of the following function's inputs
 processgcode('OUTPUT_HollowCube', printcommands, nozzletemp=[200, 220, 200], bedtemp=[65, 50], retraction=3)
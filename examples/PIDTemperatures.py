@@ -1,9 +1,14 @@
+import os
+import sys
 import time
 import serial
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from live_plot import LiveRenderer  # Blitted plotting from the top level of the repo
+
 com = "COM7"  # Change this to the COM port identified in Pronterface
 
 if 'ser' in globals() and not ser.isOpen():  # Checks if ser is defined already and if connection is open
@@ -110,6 +115,11 @@ kp_slider.on_changed(update)
 ki_slider.on_changed(update)
 kd_slider.on_changed(update)
 ax = fig.add_subplot()
+nozzle_line, = ax.plot([], [], 'r-')
+target_line, = ax.plot([], [])
+ax.set_ylabel('Nozzle Temperature')
+ax.set_xlabel('Time')
+renderer = LiveRenderer(ax, [nozzle_line, target_line])  # Only redraws the axes when the data leaves them
 plt.ion()  # Interactive figure
 
 
@@ -136,12 +146,7 @@ for m in range(1, maxtimesteps):  # For loop to read obtaining temperature value
         t = np.append(t, [float(tim)])
 
         # Update interactive figure
-        plt.cla()
-        plt.plot(t, nozzle_data, 'r-')
-        plt.plot(t, targets)
-        plt.ylabel('Nozzle Temperature')
-        plt.xlabel('Time')
-        plt.draw()
+        renderer.refresh(t, [nozzle_data, targets])
         plt.pause(0.0001)
 
 
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import numpy as np
+
+COLUMNS = 'GFXYZE'  # Layout of the command array used by processgcode
+NUMBER_CHARS = np.frombuffer(b'0123456789+-.', dtype=np.uint8)
+
+
+def command_codes(raw, positions):
+    # Integer after the letter at each position (e.g. 92 for 'G92'), -1 if there are no digits
+    digits = raw[positions[:, None] + np.arange(1, 5)].astype(np.int64) - ord('0')
+    is_digit = np.cumprod((digits >= 0) & (digits <= 9), axis=1).astype(bool)
+    code = np.zeros(len(positions), dtype=np.int64)
+    for k in range(digits.shape[1]):
+        code = np.where(is_digit[:, k], code * 10 + digits[:, k], code)
+    return np.where(is_digit[:, 0], code, -1)
+
+
+def forward_fill(values):
+    # Replace NaNs by the last value before them (NaN until the first value)
+    if not len(values):
+        return values.copy()
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(index, out=index)
+    filled = values[index]
+    filled[np.isnan(values[0]) & (index == 0)] = np.nan
+    return filled
+
+
+def parse_gcode(data):
+    # Command array [G, F, X, Y, Z, E] with one row per G0/G1 move in the G-code bytes
+    # Missing X/Y/Z/E are NaN like addvariable expects, F is modal so it carries over from earlier moves,
+    # and E is converted to relative amounts (as processgcode sends M83) taking M82/M83 and G92 E into account
+    # XYZ are taken as given, i.e. absolute positioning (G90). Line numbers (N) and checksums are skipped
+    # Every letter starts a word (G1X3Y4E5 is X3 Y4 E5), except a lowercase e between a digit and a
+    # (signed) digit, which is the exponent slicers print for tiny values (E3e-05)
+    raw = np.frombuffer(bytes(data) + b'\n    ', dtype=np.uint8)
+    newline = raw == ord('\n')
+    line_id = np.cumsum(newline) - newline  # Line number of each byte
+
+    # Comments and checksums: everything from ';' or '*' to the end of the line
+    marker = np.where((raw == ord(';')) | (raw == ord('*')), line_id, -1)
+    comment = np.maximum.accumulate(marker) == line_id
+    upper = np.where((raw >= ord('a')) & (raw <= ord('z')), raw - 32, raw)
+    digit = (raw >= ord('0')) & (raw <= ord('9'))
+    signed_digit = digit[1:] | (np.isin(raw[1:], NUMBER_CHARS[10:12]) & np.r_[digit[2:], False])
+    exponent = (raw == ord('e')) & np.r_[False, digit[:-1] | (raw[:-1] == ord('.'))] & np.r_[signed_digit, False]
+    is_letter = (upper >= ord('A')) & (upper <= ord('Z')) & ~comment & ~exponent
+
+    # The command of each line is its first letter after any line number and the number after it
+    letters = np.flatnonzero(is_letter & (upper != ord('N')))
+    first = letters[np.r_[True, line_id[letters][1:] != line_id[letters][:-1]]] if len(letters) else letters
+    keys = upper[first].astype(np.int64) * 10000 + command_codes(raw, first)
+    n_lines = line_id[-1] + 1
+    line_key = np.full(n_lines, -1, dtype=np.int64)
+    line_key[line_id[first]] = keys
+    G, M = ord('G') * 10000, ord('M') * 10000
+    is_move = (line_key == G) | (line_key == G + 1)
+    is_reset = line_key == G + 92
+
+    # Tokenise the lines we need: blank everything else and read all numbers in one call
+    keep = (is_move | is_reset)[line_id] & ~comment
+    tokens = np.flatnonzero(is_letter & keep)
+    has_number = np.isin(raw[tokens + 1], NUMBER_CHARS)
+    numeric = keep & (np.isin(raw, NUMBER_CHARS) | exponent)
+    text = np.where(numeric, raw, ord(' ')).astype(np.uint8).tobytes()
+    values = np.array(text.split(), dtype=np.float64)
+    tokens = tokens[has_number]
+    if len(values) != len(tokens):
+        raise ValueError('Could not match every number in the G-code to an axis letter')
+    token_line = line_id[tokens]
+    sorted_letters = np.frombuffer(b'EFGXYZ', dtype=np.uint8)
+    found = np.minimum(np.searchsorted(sorted_letters, upper[tokens]), len(sorted_letters) - 1)
+    token_column = np.array([5, 1, 0, 2, 3, 4])[found]  # EFGXYZ -> column in GFXYZE
+    token_column[sorted_letters[found] != upper[tokens]] = -1  # Other letters are ignored
+
+    # Scatter the words of move lines into rows
+    move_lines = np.flatnonzero(is_move)
+    row_of_line = np.cumsum(is_move) - 1
+    commands = np.full((len(move_lines), len(COLUMNS)), np.nan)
+    on_move = is_move[token_line] & (token_column >= 0)
+    commands[row_of_line[token_line[on_move]], token_column[on_move]] = values[on_move]
+    commands[:, 0] = line_key[move_lines] - G
+    commands[:, 1] = forward_fill(commands[:, 1])
+
+    # Relative E: forward fill the extrusion mode (Marlin starts absolute, M82) over the lines
+    mode_line = np.full(n_lines, np.nan)
+    mode_line[line_key == M + 82] = 1.0
+    mode_line[line_key == M + 83] = 0.0
+    absolute = forward_fill(mode_line)
+    absolute = np.where(np.isnan(absolute), 1.0, absolute).astype(bool)
+
+    # Every line that moves or sets E, in order: G92 E and absolute moves set the position,
+    # relative moves add to it. Position = last set value + sum of relative moves since then
+    e_token = upper[tokens] == ord('E')
+    e_lines = token_line[e_token & (is_move | is_reset)[token_line]]
+    e_values = values[e_token & (is_move | is_reset)[token_line]]
+    sets = is_reset[e_lines] | absolute[e_lines]
+    anchor = np.maximum.accumulate(np.where(sets, np.arange(len(e_lines)), -1))
+    increments = np.where(sets, 0.0, e_values)
+    total = np.cumsum(increments)
+    anchor_value = np.where(anchor >= 0, e_values[np.maximum(anchor, 0)], 0.0)
+    anchor_total = np.where(anchor >= 0, total[np.maximum(anchor, 0)], 0.0)
+    position = anchor_value + total - anchor_total
+    previous = np.r_[0.0, position[:-1]]
+    moves = is_move[e_lines]
+    relative_e = np.where(sets, position - previous, e_values)[moves]
+    commands[row_of_line[e_lines[moves]], 5] = relative_e
+    return commands
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def write_atomic(path, save):
+    # Calls save(file) on a temporary file, then renames it to path, so readers never see a partial file
+    partial = path + '.' + str(os.getpid()) + '.tmp'
+    with open(partial, 'wb') as file:
+        save(file)
+    os.replace(partial, path)
+
+
+def load_gcode(filename, cache_dir=None):
+    # Command array for a G-code file, cached as <cache_dir>/<name>_<hash of the file contents>.npy
+    # The cache defaults to a .cache folder next to the file; an unchanged file is loaded from it
+    # <name>.stat records the size and mtime the hash was taken at, so an untouched file is not read at all
+    cache_dir = cache_dir or os.path.join(os.path.dirname(filename), '.cache')
+    name = os.path.splitext(os.path.basename(filename))[0]
+    index = os.path.join(cache_dir, name + '.stat')
+    stat = os.stat(filename)
+    stat_key = str(stat.st_size) + ' ' + str(stat.st_mtime_ns)
+    if os.path.exists(index):
+        with open(index) as file:
+            indexed_key, _, indexed_hash = file.read().rpartition(' ')
+        cached = os.path.join(cache_dir, name + '_' + indexed_hash + '.npy')
+        if indexed_key == stat_key and os.path.exists(cached):
+            return np.load(cached, mmap_mode='r')
+
+    with open(filename, 'rb') as file:
+        data = file.read()
+    digest = content_hash(data)
+    cached = os.path.join(cache_dir, name + '_' + digest + '.npy')
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(cached):  # Touched but unchanged
+        commands = np.load(cached, mmap_mode='r')
+    else:
+        commands = parse_gcode(data)
+        write_atomic(cached, lambda file: np.save(file, commands))
+    write_atomic(index, lambda file: file.write((stat_key + ' ' + digest).encode()))
+    return commands
@@ -1,3 +1,5 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from scipy import interpolate
 
@@ -19,27 +21,103 @@ def addvariable(command, index, string):
         return ' ' + string + str(command[index])
 
 
-def processgcode(filestub, commands, kp=15.5, ki=0.13, kd=6.0, nozzletemp=210, bedtemp=55, speedfactor=1,
-                 extrusionfactor=1, retraction=2.5, fanspeed=255):
+def format_column(values, prefix):
+    # Vectorised addvariable: ' <prefix><value>' for each value, '' where it is undefined (NaN)
+    text = np.array([prefix + value for value in map(repr, values.tolist())], dtype=object)
+    text[np.isnan(values)] = ''
+    return text
+
+
+def changed_lines(values, template):
+    # Lines from template for each row whose schedule values differ from the previous row, '' otherwise
+    # values: 2D array with one row per command (plus the previous command first), one column per value
+    changed = np.any(values[1:] != values[:-1], axis=1)
+    lines = np.full(len(changed), '', dtype=object)
+    lines[changed] = [template.format(*map(repr, row)) for row in values[1:][changed].tolist()]
+    return lines
+
+
+def format_commands(commands, schedules, start=2, offset=0):
+    # G-code for commands[start:] in one pass over column arrays (same output as the per-command loop)
+    # Row k of commands is command number offset+k of the print, which is where the schedules are evaluated
+    # Like the loop, this applies the speed, extrusion and retraction factors to commands in place
+    indices = np.arange(offset + start - 1, offset + len(commands))
+    values = {name: f(indices) for name, f in schedules.items()}  # values[name][k] is at row start-1+k
+    rows = commands[start:]
+
+    # Retraction and extrusion factors: the loop tested the previous command's E after its own factors
+    # were applied, so a retraction only counts if it was set to a retraction above 0 (0 gives -0.0, not < 0)
+    # The first command (number 1) is never modified. Other moves stay positive for non-negative factors
+    extrusion = rows[:, 5]
+    previous_retracted = (commands[start - 1:-1, 5] < 0) & ((values['retraction'][:-1] > 0) | (indices[:-1] == 1))
+    retract = extrusion < 0
+    unretract = ~retract & previous_retracted
+    rows[:, 1] *= values['speedfactor'][1:]  # Apply speed factor
+    extrusion[:] = np.where(retract, -values['retraction'][1:],
+                            np.where(unretract, values['retraction'][1:], extrusion * values['extrusionfactor'][1:]))
+
+    # Change PID controls, temperatures and fan speed when necessary
+    output = changed_lines(np.stack([values['kp'], values['ki'], values['kd']], axis=1), 'M301 P{} I{} D{}\n')
+    output += changed_lines(values['nozzletemp'][:, None], 'M104 S{}\n')
+    output += changed_lines(values['bedtemp'][:, None], 'M140 S{}\n')
+    output += changed_lines(values['fanspeed'][:, None], 'M106 S{}\n')
+
+    output += np.array(['G' + code for code in map(str, rows[:, 0].astype(int).tolist())], dtype=object)
+    output += format_column(rows[:, 2], ' X')  # Add X command if it exists
+    output += format_column(rows[:, 3], ' Y')  # Add Y command if it exists
+    output += format_column(rows[:, 4], ' Z')  # Add Z command if it exists
+    output += format_column(rows[:, 5], ' E')  # Add E command if it exists
+    return '\n'.join(output.tolist()) + '\n' if len(output) else ''
+
+
+def format_chunk(chunk, schedules, offset):
+    # Process pool task: gcode for rows 1: of a chunk that starts with the command before it
+    return format_commands(chunk, schedules, start=1, offset=offset)
+
+
+def parallel_chunks(tasks, processes):
+    # Runs format_chunk over tasks in a process pool, yielding the results in order
+    # Only a few chunks per process are in flight, so memory use stays bounded
+    with ProcessPoolExecutor(processes) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(format_chunk, *task))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def create_schedules(length, **variables):
+    # Interpolation function for each variable over a print of length commands
+    return {name: interpolate_variable(variable, length) for name, variable in variables.items()}
+
+
+def load_commands(filename):
+    # Memory-map a command array so that only the chunks being processed are read into memory
+    return np.load(filename, mmap_mode='r')
+
+
+def generate_gcode(commands, kp=15.5, ki=0.13, kd=6.0, nozzletemp=210, bedtemp=55, speedfactor=1,
+                   extrusionfactor=1, retraction=2.5, fanspeed=255, chunksize=100000, processes=None):
+    # Yields the gcode for commands piece by piece, handling chunksize commands at a time
+    # Writable command arrays are modified in place; read-only (memory-mapped) ones are processed in copies
+    # With processes > 1 the chunks are formatted in a process pool (on copies) and yielded in order,
+    # giving the same output as the serial path
 
     # Safety limits: to prevent damage to the printer
-    assert 190 <= nozzletemp <= 260
-    assert bedtemp <= 75
-    assert extrusionfactor <= 2
-    assert retraction <= 15
+    assert np.all((190 <= np.asarray(nozzletemp)) & (np.asarray(nozzletemp) <= 260))
+    assert np.all(np.asarray(bedtemp) <= 75)
+    assert np.all(np.asarray(extrusionfactor) <= 2)
+    assert np.all(np.asarray(retraction) <= 15)
 
     # Create interpolation functions
-    fkp = interpolate_variable(kp, len(commands))
-    fki = interpolate_variable(ki, len(commands))
-    fkd = interpolate_variable(kd, len(commands))
-    fnozzletemp = interpolate_variable(nozzletemp, len(commands))
-    fbedtemp = interpolate_variable(bedtemp, len(commands))
-    fspeedfactor = interpolate_variable(speedfactor, len(commands))
-    fextrusionfactor = interpolate_variable(extrusionfactor, len(commands))
-    fretraction = interpolate_variable(retraction, len(commands))
-    ffanspeed = interpolate_variable(fanspeed, len(commands))
-
-    # All gcode is saved in output variable, which is saved to file at the end
+    schedules = create_schedules(len(commands), kp=kp, ki=ki, kd=kd, nozzletemp=nozzletemp, bedtemp=bedtemp,
+                                 speedfactor=speedfactor, extrusionfactor=extrusionfactor, retraction=retraction,
+                                 fanspeed=fanspeed)
+    fkp, fki, fkd = schedules['kp'], schedules['ki'], schedules['kd']
+    fnozzletemp, fbedtemp, ffanspeed = schedules['nozzletemp'], schedules['bedtemp'], schedules['fanspeed']
+
     output = 'M301 P' + str(fkp(0)) + ' I' + str(fki(0)) + ' D' + str(fkd(0)) + '\n'  # Set initial PID parameters
     output += 'M140 S' + str(fbedtemp(0)) + '\n' + 'M190 S' + str(fbedtemp(0)) + '\n'  # Set initial bed temperature
     output += 'M104 S' + str(fnozzletemp(0)) + '\n' + 'M109 S' \
@@ -56,44 +134,33 @@ def processgcode(filestub, commands, kp=15.5, ki=0.13, kd=6.0, nozzletemp=210, b
     output += '\nG1 F2400 E2.5\n'
 
     output += 'M106 S' + str(ffanspeed(0)) + '\n'  # Set initial fan speed
-
-    # Walk through all remaining commands
-    for i in range(2, len(commands)):
-        if i % 1000 == 0:
-            print(str(i) + '/' + str(len(commands)) + ' commands')
-        commands[i][1] *= fspeedfactor(i) # Apply speed factor
-        if commands[i][5] < 0:
-            commands[i][5]= -fretraction(i) # Apply retraction
-        elif commands[i-1][5] < 0:
-            commands[i][5] = fretraction(i) # Apply retraction
-        else:
-            commands[i][5] *= fextrusionfactor(i) # Apply extrusion factor
-
-        # Change PID controls when necessary
-        if float(fkp(i)) != float(fkp(i-1)) or float(fki(i)) != float(fki(i-1)) or float(fkd(i)) != float(fkd(i-1)):
-            output += 'M301 P' + str(fkp(i)) + ' I' + str(fki(i)) + ' D' + str(fkd(i)) +'\n'
-        # Change hotend temperature when necessary
-        if float(fnozzletemp(i)) != float(fnozzletemp(i-1)):
-            output += 'M104 S' + str(fnozzletemp(i)) + '\n'
-        # Change bed temperature when necessary
-        if float(fbedtemp(i)) != float(fbedtemp(i-1)):
-            output += 'M140 S' + str(fbedtemp(i)) + '\n'
-        # Change fan speed when necessary
-        if float(ffanspeed(i)) != float(ffanspeed(i-1)):
-            output += 'M106 S' + str(ffanspeed(i)) + '\n'
-
-        output += 'G' + str(int(commands[i][0]))
-        output += addvariable(commands[i], 2, 'X')  # Add X command if it exists
-        output += addvariable(commands[i], 3, 'Y')  # Add Y command if it exists
-        output += addvariable(commands[i], 4, 'Z')  # Add Z command if it exists
-        output += addvariable(commands[i], 5, 'E')  # Add E command if it exists
-        output += '\n'
+    yield output
+
+    # Walk through all remaining commands a chunk at a time, each with the command before it
+    # The command before and the schedules at the chunk's own indices are all the state a chunk needs
+    starts = range(2, len(commands), chunksize)
+    if processes and processes > 1:
+        tasks = ((np.array(commands[start - 1:start + chunksize]), schedules, start - 1) for start in starts)
+        chunks = parallel_chunks(tasks, processes)
+    else:
+        chunks = (format_chunk(commands[start - 1:start + chunksize] if commands.flags.writeable
+                               else np.array(commands[start - 1:start + chunksize]), schedules, start - 1)
+                  for start in starts)
+    for start, text in zip(starts, chunks):
+        yield text
+        print(str(min(start + chunksize, len(commands))) + '/' + str(len(commands)) + ' commands')
 
     # Closing code
-    output += 'M107\nG0 X0 Y120\nM190 S0\nG1 E-3 F200\nM104 S0\nG4 S300\nM107\nM84'
+    yield 'M107\nG0 X0 Y120\nM190 S0\nG1 E-3 F200\nM104 S0\nG4 S300\nM107\nM84'
+
 
-    # Write output to file
+def processgcode(filestub, commands, kp=15.5, ki=0.13, kd=6.0, nozzletemp=210, bedtemp=55, speedfactor=1,
+                 extrusionfactor=1, retraction=2.5, fanspeed=255, chunksize=100000, processes=None):
+    # Write output to file through a buffered handle as it is generated
     filename = 'outputgcode/' + filestub + '.gcode'
-    file = open(filename, 'w')
-    file.write(output)
-    file.close()
\ No newline at end of file
+    with open(filename, 'w', buffering=1 << 20) as file:
+        for text in generate_gcode(commands, kp=kp, ki=ki, kd=kd, nozzletemp=nozzletemp, bedtemp=bedtemp,
+                                   speedfactor=speedfactor, extrusionfactor=extrusionfactor,
+                                   retraction=retraction, fanspeed=fanspeed, chunksize=chunksize,
+                                   processes=processes):
+            file.write(text)
@@ -1,3 +1,4 @@
+import os
 import time
 import serial
 #import numpy as np
@@ -6,7 +7,7 @@ import serial
 bar_height = 51       ## Sets the height of the bars used in to create the strings                       
 
 # print('please input the name of the port that the printer is connected to (e.g. COM6)')
-com = "COM7"
+com = os.environ.get("PRINTER_PORT", "COM7")  # e.g. the pty printed by simulator.py
 
 if 'ser' in globals() and ser.isOpen() == False: ## checks if ser is defined already and if connection is open
     ## configures the serial connection:
@@ -0,0 +1,111 @@
+# Feedforward filters from feed rate to target temperature
+import collections
+import math
+import numpy as np
+
+
+class DelayLine:
+  """Returns each sample `samples` ticks after it was pushed (`initial` until then)"""
+
+  def __init__(self, samples, initial=0.0):
+    self.samples = int(samples)
+    self._buffer = collections.deque([initial] * self.samples, maxlen=self.samples) if self.samples else None
+
+  def step(self, x):
+    if not self.samples:
+      return x
+    y = self._buffer[0]
+    self._buffer.append(x)
+    return y
+
+
+class IIRFilter:
+  """Discrete transfer function b(z^-1) / a(z^-1), direct form II transposed
+
+  b, a: coefficients of z^0, z^-1, ... (a[0] is normalised to 1)
+  """
+
+  def __init__(self, b, a):
+    b, a = np.atleast_1d(np.asarray(b, dtype=np.float64)), np.atleast_1d(np.asarray(a, dtype=np.float64))
+    order = max(len(b), len(a))
+    self.b = list(np.pad(b, (0, order - len(b))) / a[0])
+    self.a = list(np.pad(a, (0, order - len(a))) / a[0])
+    self.reset()
+
+  @classmethod
+  def from_continuous(cls, num, den, dt):
+    """Discretise num(s) / den(s) (highest power first) with the bilinear transform"""
+    order = max(len(num), len(den)) - 1
+    c = 2.0 / dt
+
+    def substitute(poly):
+      # sum_k p_k s^k with s = c (z - 1) / (z + 1), times (z + 1)^order
+      out = np.zeros(order + 1)
+      for power, coeff in enumerate(np.asarray(poly, dtype=np.float64)[::-1]):
+        term = np.polymul(np.poly(np.ones(power)), np.poly(-np.ones(order - power)))
+        out += coeff * c ** power * term
+      return out
+
+    return cls(substitute(num), substitute(den))
+
+  def reset(self):
+    self._state = [0.0] * (len(self.b) - 1)
+
+  def step(self, x):
+    b, a, state = self.b, self.a, self._state
+    y = b[0] * x + (state[0] if state else 0.0)
+    for i in range(len(state) - 1):
+      state[i] = b[i + 1] * x - a[i + 1] * y + state[i + 1]
+    if state:
+      state[-1] = b[-1] * x - a[-1] * y
+    return y
+
+
+class FeedforwardFilter:
+  """Target temperature offset from the feed rate: gain * sections(delay(feed rate))
+
+  The feed rate is delayed by a DelayLine and passed through a cascade of
+  IIRFilter sections, so each tick costs O(1) whatever the feed rate
+  profile (steps, ramps, a flow derived from G-code) and however long the
+  run has been going.
+  """
+
+  def __init__(self, delay_samples=0, sections=(), gain=1.0):
+    self.delay = DelayLine(delay_samples)
+    self.sections = list(sections)
+    self.gain = gain
+
+  def step(self, feed_rate):
+    """Offset to add to the target for this tick's feed rate"""
+    x = self.delay.step(feed_rate)
+    for section in self.sections:
+      x = section.step(x)
+    return self.gain * x
+
+  def reset(self):
+    self.delay = DelayLine(self.delay.samples)
+    for section in self.sections:
+      section.reset()
+
+
+def decaying_step_ff(dist_K, dist_tau, dist_T, dt, feedrate_ref=350.0):
+  """The FF law of PID_with_extrusion_withFF.py as a filter
+
+  For a feed rate step F at t = 0 it gives dist_K * F * exp(-t / dist_T) / feedrate_ref
+  from t = dist_tau on, i.e. K e^(-tau/T) e^(-tau s) T s / (T s + 1) / feedrate_ref. The
+  washout is discretised exactly for steps: y[n] = e^(-dt/T) y[n-1] + x[n] - x[n-1].
+  """
+  if dist_T <= 0:
+    raise ValueError(f"dist_T must be positive, got {dist_T}")
+  samples = int(dist_tau / dt)
+  if math.isinf(dist_T):
+    # No decay: a delayed, scaled copy of the feed rate
+    return FeedforwardFilter(samples, gain=dist_K / feedrate_ref)
+  pole = math.exp(-dt / dist_T)
+  washout = IIRFilter([1.0, -1.0], [1.0, -pole])
+  return FeedforwardFilter(samples, [washout], gain=dist_K * math.exp(-samples * dt / dist_T) / feedrate_ref)
+
+
+def transfer_function_ff(num, den, delay, dt):
+  """FF filter e^(-delay s) num(s) / den(s), e.g. -D(s) / L(s) from the identified models"""
+  return FeedforwardFilter(int(round(delay / dt)), [IIRFilter.from_continuous(num, den, dt)])
@@ -0,0 +1,126 @@
+# Offline sweep of the feedforward parameters
+import argparse
+import numpy as np
+from run_metrics import step_metrics
+from simulator import PID_FUNCTIONAL_RANGE, PID_MAX, ThermalPlant
+
+
+def sweep_grid(**values):
+  """Every combination of the given parameter values, as flat arrays of equal length"""
+  mesh = np.meshgrid(*(np.atleast_1d(np.asarray(v, dtype=np.float64)) for v in values.values()), indexing='ij')
+  return {name: m.ravel() for name, m in zip(values, mesh)}
+
+
+def marlin_pid_batch(state, target, temp, dt, kp, ki, kd):
+  """MarlinPID.update for arrays of controllers; state holds 'i_state' and 'last_temp' arrays"""
+  error = target - temp
+  d_temp = (temp - state['last_temp']) / dt
+  state['last_temp'] = temp
+  i_state = state['i_state'] + error * dt
+  if ki > 0:
+    i_state = np.clip(i_state, 0.0, PID_MAX / ki)
+  output = np.clip(kp * error + ki * i_state - kd * d_temp, 0, PID_MAX)
+  # Bang-bang outside the functional range, with the integral reset
+  far = np.abs(error) > PID_FUNCTIONAL_RANGE
+  state['i_state'] = np.where(far, 0.0, i_state)
+  return np.where(error > PID_FUNCTIONAL_RANGE, PID_MAX, np.where(error < -PID_FUNCTIONAL_RANGE, 0, output))
+
+
+def simulate_ff(dist_K, dist_tau, dist_T, plant=None, kp=33, ki=0.04, kd=67.8, temp_target=200.0,
+                feed_rate=360.0, extrude_feedrate=350.0, timestep=0.5, step_time=20.0, duration=200.0,
+                fan=0.0, noise=0.0, seed=None):
+  """Closed-loop response to an extrusion step for a batch of FF parameter sets
+
+  Simulates what PID_with_extrusion_withFF.py does on the printer: the hotend
+  (a ThermalPlant, Marlin PID at the plant's dt) and, every `timestep`, the
+  host reading the temperature and sending the FF target
+  temp_target + dist_K * f(t - dist_tau) * exp(-t / dist_T) / extrude_feedrate,
+  with t the time since extrusion started. The hotend starts settled at
+  temp_target and extrudes at feed_rate mm/min from step_time on.
+
+  dist_K, dist_tau, dist_T: arrays (or scalars) broadcast to one batch
+  Returns times (ticks,) and the temperature readings and targets, each (batch, ticks).
+  """
+  dist_K, dist_tau, dist_T = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype=np.float64))
+                                                   for v in (dist_K, dist_tau, dist_T)))
+  batch = len(dist_K)
+  plant = plant or ThermalPlant(noise=noise)
+  rng = np.random.default_rng(seed)
+  dt = plant.dt
+  substeps = max(1, int(round(timestep / dt)))
+  ticks = int(round((step_time + duration) / timestep))
+  times = np.arange(ticks) * timestep
+  feed = np.where(times >= step_time, feed_rate, 0.0)  # Feed rate sent at each tick
+  step_tick = np.argmax(feed > 0)
+  lag = (dist_tau / timestep).astype(int)
+
+  # Settled at the target: the integral term holds the heater power that balances the losses
+  idle_conductance = plant.loss + plant.fan_loss * fan
+  duty = idle_conductance * (temp_target - plant.ambient) / plant.heater_power
+  temp = np.full(batch, float(temp_target))
+  state = dict(i_state=np.full(batch, duty * PID_MAX / ki if ki > 0 else 0.0), last_temp=temp.copy())
+  delay = max(1, int(round(plant.sensor_delay / dt)))
+  history = np.full((delay + 1, batch), float(temp_target))  # Ring buffer of true temperatures
+  oldest = 0
+
+  readings = np.empty((batch, ticks))
+  targets = np.empty((batch, ticks))
+  for k in range(ticks):
+    # Host: read the temperature, then send the FF target
+    readings[:, k] = history[oldest] + plant.noise * rng.standard_normal(batch)
+    if feed[k] > 0:
+      t = (k - step_tick) * timestep
+      target = temp_target + dist_K * feed[np.maximum(k - lag, 0)] * np.exp(-t / dist_T) / extrude_feedrate
+    else:
+      target = np.full(batch, float(temp_target))
+    targets[:, k] = target
+
+    # Printer: PID and plant at the plant's time step
+    conductance = idle_conductance + plant.extrude_loss * feed[k]
+    for _ in range(substeps):
+      measured = history[oldest] + plant.noise * rng.standard_normal(batch)
+      output = marlin_pid_batch(state, target, measured, dt, kp, ki, kd)
+      temp = temp + (plant.heater_power * output / PID_MAX
+                     - conductance * (temp - plant.ambient)) * dt / plant.heat_capacity
+      history[oldest] = temp
+      oldest = (oldest + 1) % len(history)
+  return times, readings, targets
+
+
+def ff_sweep(dist_K, dist_tau, dist_T, temp_target=200.0, step_time=20.0, duration=200.0, **options):
+  """Predicted error after the extrusion step for every combination of the given FF parameters
+
+  Returns a dict of the parameter arrays and the run_metrics.step_metrics of each combination
+  (step_mse, step_peak_deviation, iae, ...).
+  """
+  params = sweep_grid(dist_K=dist_K, dist_tau=dist_tau, dist_T=dist_T)
+  times, readings, _ = simulate_ff(**params, temp_target=temp_target, step_time=step_time,
+                                   duration=duration, **options)
+  batch = len(readings)
+  step_idx = np.full(batch, int(np.searchsorted(times, step_time)))
+  metrics = step_metrics(np.broadcast_to(times, readings.shape), readings, np.full(batch, temp_target),
+                         step_idx, step_window=duration)
+  return {**params, **metrics}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Simulate the extrusion step for a grid of FF parameters")
+  parser.add_argument("--k", type=float, nargs=3, default=[0, 4, 21], metavar=("MIN", "MAX", "NUM"))
+  parser.add_argument("--tau", type=float, nargs=3, default=[0, 10, 21], metavar=("MIN", "MAX", "NUM"))
+  parser.add_argument("--T", type=float, nargs=3, default=[5, 200, 20], metavar=("MIN", "MAX", "NUM"),
+                      help="log spaced")
+  parser.add_argument("--metric", default="step_mse")
+  parser.add_argument("--top", type=int, default=10)
+  args = parser.parse_args()
+
+  results = ff_sweep(np.linspace(args.k[0], args.k[1], int(args.k[2])),
+                     np.linspace(args.tau[0], args.tau[1], int(args.tau[2])),
+                     np.geomspace(args.T[0], args.T[1], int(args.T[2])))
+  order = np.argsort(np.abs(results[args.metric]))
+  baseline = np.flatnonzero(results['dist_K'] == 0)
+  if len(baseline):
+    print(f"No FF: {args.metric}={results[args.metric][baseline[0]]:.4g}")
+  for i in order[:args.top]:
+    print(f"dist_K={results['dist_K'][i]:.3g} dist_tau={results['dist_tau'][i]:.3g} "
+          f"dist_T={results['dist_T'][i]:.3g}: {args.metric}={results[args.metric][i]:.4g}, "
+          f"peak={results['step_peak_deviation'][i]:.3g}")
@@ -0,0 +1,137 @@
+# Streaming G-code sender
+import argparse
+import collections
+import re
+import threading
+import time
+import utils
+import transport
+
+RESEND_PATTERN = re.compile(r'^(?:Resend|rs)[:\s]\s*N?:?\s*(\d+)', re.IGNORECASE)
+
+
+def strip_gcode(lines):
+  """Yield commands with comments and blank lines removed"""
+  for line in lines:
+    command = line.split(';')[0].strip()
+    if command:
+      yield command
+
+
+def number_line(number, command):
+  """Add a line number and checksum: 'N<number> <command>*<checksum>'"""
+  line = f"N{number} {command}"
+  return f"{line}*{utils.gcode_checksum(line)}"
+
+
+class GcodeSender:
+  """Streams G-code to the printer, keeping its command buffer full
+
+  Up to `window` lines are in flight at once; each `ok` frees one slot
+  (Marlin's BUFSIZE is 4). Lines are numbered and checksummed, and a
+  `Resend: N` from the firmware rewinds the stream to line N.
+  """
+
+  def __init__(self, ser: transport.SerialTransport, window=4, history=256):
+    self.ser = ser
+    self.window = window
+    self._history = collections.OrderedDict()  # line number -> [numbered line, send sequence]
+    self._history_size = max(history, 4 * window)
+    self._credits = threading.Semaphore(window)
+    self._lock = threading.Lock()
+    self._resend_from = None
+    self._ignore_resends = 0
+    self.lines_sent = 0
+    self.bytes_sent = 0
+    self.resends = 0
+
+  def stream(self, lines, progress_every=1000):
+    """Send all commands in `lines` (an iterable of str) and wait for the last ok
+
+    Returns a dict of throughput statistics.
+    """
+    self.ser.send('M110 N0').result()  # Reset the firmware's line number
+    self.ser.add_listener(self._on_line)
+    start = time.perf_counter()
+    commands = strip_gcode(lines)
+    number = 0
+    last_future = None
+    try:
+      while True:
+        self._credits.acquire()
+        resend = self._take_resend()
+        if resend is not None:
+          self._credits.release()
+          for n in range(resend, number + 1):
+            self._credits.acquire()
+            last_future = self._send(n)
+          continue
+        command = next(commands, None)
+        if command is None:
+          self._credits.release()
+          # A resend can still be requested by the last lines in flight
+          last_future and last_future.result()
+          if self._resend_from is None:
+            break
+          continue
+        number += 1
+        self._history[number] = [number_line(number, command), 0]
+        while len(self._history) > self._history_size:
+          self._history.popitem(last=False)
+        last_future = self._send(number)
+        if progress_every and number % progress_every == 0:
+          print(f"{number} lines sent, {number / (time.perf_counter() - start):.0f} lines/s")
+    finally:
+      self.ser.remove_listener(self._on_line)
+    seconds = time.perf_counter() - start
+    return dict(lines=number, lines_sent=self.lines_sent, resends=self.resends, bytes=self.bytes_sent,
+                seconds=seconds, lines_per_second=number / seconds if seconds else float('inf'))
+
+  def _send(self, number):
+    entry = self._history[number]
+    self.lines_sent += 1
+    entry[1] = self.lines_sent  # Send sequence number, to count rejected lines on resend
+    self.bytes_sent += len(entry[0]) + 1
+    future = self.ser.send(entry[0])
+    future.add_done_callback(lambda _: self._credits.release())
+    return future
+
+  def _take_resend(self):
+    """Line to rewind to, if the firmware asked for one"""
+    with self._lock:
+      number, self._resend_from = self._resend_from, None
+      if number is not None:
+        # Every line sent after the bad one is rejected too, and asks for the same resend
+        self._ignore_resends += self.lines_sent - self._history[number][1]
+      return number
+
+  def _on_line(self, line):
+    """Listener on the transport's reader thread"""
+    match = RESEND_PATTERN.match(line)
+    if match is None:
+      return
+    with self._lock:
+      if self._ignore_resends > 0 or self._resend_from is not None:
+        # Echo of a resend we have already seen (counted against the rewind)
+        self._ignore_resends -= 1
+        return
+      self._resend_from = int(match.group(1))
+      self.resends += 1
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Stream a G-code file to the printer")
+  parser.add_argument("filename")
+  parser.add_argument("--port", default="COM6")
+  parser.add_argument("--baudrate", type=int, default=38400)
+  parser.add_argument("--window", type=int, default=4, help="commands in flight (firmware BUFSIZE)")
+  args = parser.parse_args()
+
+  ser = transport.get_serial_transport(port=args.port, baudrate=args.baudrate)
+  try:
+    with open(args.filename) as file:
+      stats = GcodeSender(ser, window=args.window).stream(file)
+    print(f"Sent {stats['lines']} lines in {stats['seconds']:.1f}s "
+          f"({stats['lines_per_second']:.0f} lines/s, {stats['resends']} resends)")
+  finally:
+    utils.close_printer(ser, cool=False)
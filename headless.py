@@ -0,0 +1,244 @@
+# Run experiments without a GUI, driven by a timed script and/or a UNIX control socket
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+from orchestrator import EXPERIMENTS, Orchestrator, parse_run
+from telemetry_server import TelemetryServer
+
+# Command name -> [(argument name, type)]
+COMMANDS = {
+  'status': [],
+  'phase': [('N', int)],
+  'target': [('T', float)],
+  'save': [],
+  'stop': [],
+}
+
+
+class Runner:
+  """Runs an Orchestrator and takes commands, instead of key presses in a plot window
+
+  Commands (one per line, from `script` or the control socket):
+    status          state of each run
+    phase N         set the experiment phase (ff: 1 extrudes, 0 stops)
+    target T        set the target temperature / C
+    save            snapshot the recorded data as .npy files
+    stop            end the runs and cool down
+  `script` is a list of (seconds after start, command). With a
+  `telemetry` TelemetryServer each run's rows are published on a channel
+  named after its port.
+  """
+
+  def __init__(self, orchestrator: Orchestrator, script=(), socket_path=None, telemetry=None):
+    self.orchestrator = orchestrator
+    self.script = sorted(script, key=lambda entry: entry[0])
+    self.socket_path = socket_path
+    self.telemetry = telemetry
+    self.started = None
+    self._server = None
+    self._stopped = threading.Event()
+    self._lock = threading.Lock()  # Commands come from the script and socket threads
+
+  def execute(self, command):
+    """Run one command, returns its JSON-able result"""
+    name, args = parse_command(command)
+    runs = [run for run in self.orchestrator.runs if run.error is None]
+    with self._lock:
+      if name == 'status':
+        return self.orchestrator.status()
+      if name == 'phase':
+        for run in runs:
+          run.experiment.phase = args[0]
+        return args[0]
+      if name == 'target':
+        for run in runs:
+          run.experiment.temp_target = args[0]
+        return args[0]
+      if name == 'save':
+        for run in runs:
+          # The control loop keeps appending: take every column at one row count (views reads it once)
+          columns = run.data.columns
+          for column, values in zip(columns, run.data.views(*columns)):
+            np.save(f"{run.filestub}_{column}", values)
+        return [run.filestub for run in runs]
+      if name == 'stop':
+        self._stopped.set()
+        return 'stopping'
+
+  def serve(self):
+    """Accept commands on the UNIX socket, in a background thread"""
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)  # Left over from a run that did not clean up
+    runner = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        for line in self.rfile:
+          command = line.decode(errors='replace').strip()
+          if not command:
+            continue
+          try:
+            reply = dict(ok=True, result=runner.execute(command))
+          except Exception as error:
+            reply = dict(ok=False, error=str(error))
+          self.wfile.write((json.dumps(reply) + '\n').encode())
+
+    self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, name="control-socket", daemon=True).start()
+    print(f"Control socket: {self.socket_path}")
+
+  def run(self, plot=False):
+    """Connect, start, follow the script until the runs end or are stopped, then clean up"""
+    self.orchestrator.connect()
+    if self.telemetry is not None:
+      for run in self.orchestrator.runs:
+        run.channel = self.telemetry.channel(os.path.basename(run.port), run.data.columns)
+      self.telemetry.start()
+    try:
+      self.orchestrator.start()
+      self.started = time.monotonic()
+      if self.socket_path:
+        self.serve()
+      threading.Thread(target=self._follow_script, name="script", daemon=True).start()
+      if plot:
+        self._plot()
+      while not self._stopped.wait(0.5) and self._running():
+        pass
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.close()
+
+  def close(self):
+    self._stopped.set()
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      os.path.exists(self.socket_path) and os.unlink(self.socket_path)
+      self._server = None
+    self.orchestrator.stop()
+    if self.telemetry is not None:
+      self.telemetry.close()
+
+  def _running(self):
+    return any(run.loop and run.loop.running for run in self.orchestrator.runs)
+
+  def _follow_script(self):
+    for at, command in self.script:
+      if self._stopped.wait(max(0.0, self.started + at - time.monotonic())):
+        return
+      try:
+        result = self.execute(command)
+      except Exception as error:  # Keep following the rest of the script
+        result = f"error: {error}"
+      print(f"{at:.0f}s: {command} -> {result}")
+
+  def _plot(self):
+    """Live plot of every run until its window is closed (optional: needs matplotlib)"""
+    import matplotlib.pyplot as plt
+    from live_plot import LiveRenderer, decimate_minmax, start_timer
+    fig, ax = plt.subplots()
+    runs = [run for run in self.orchestrator.runs if run.error is None]
+    lines = [ax.plot([], [], label=os.path.basename(run.port))[0] for run in runs]
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Nozzle Temp')
+    ax.legend()
+    # A LiveRenderer blits lines sharing one x array over its own background, so
+    # several runs (each with its own times) are redrawn in full instead
+    renderer = LiveRenderer(ax, lines) if len(runs) == 1 else None
+
+    def redraw(i):
+      if self._stopped.is_set() or not self._running():
+        plt.close(fig)
+        return
+      if renderer is not None:
+        times, temp = runs[0].data.views('times', 'temp')
+        renderer.refresh(times, [temp])
+        return
+      for run, line in zip(runs, lines):
+        line.set_data(*decimate_minmax(*run.data.views('times', 'temp'), int(ax.bbox.width)))
+      ax.relim()
+      ax.autoscale_view()
+      fig.canvas.draw_idle()
+    timer = start_timer(fig, redraw, interval=1000)
+    plt.show()
+    timer.stop()
+
+
+def parse_command(command):
+  """'NAME ARGS...' -> (name, [arguments]), ValueError with the usage if malformed"""
+  name, *args = command.split() or ['']
+  if name not in COMMANDS:
+    raise ValueError(f"unknown command: {command!r}")
+  params = COMMANDS[name]
+  usage = f"usage: {' '.join([name] + [param for param, _ in params])}"
+  if len(args) != len(params):
+    raise ValueError(usage)
+  try:
+    return name, [kind(arg) for (_, kind), arg in zip(params, args)]
+  except ValueError:
+    raise ValueError(usage) from None
+
+
+def parse_script(lines):
+  """'SECONDS COMMAND' lines (# comments) -> [(seconds, command)]
+
+  Every line is checked up front, a bad one raises ValueError naming it.
+  """
+  script = []
+  for number, line in enumerate(lines, 1):
+    line = line.split('#')[0].strip()
+    if not line:
+      continue
+    try:
+      at, command = (line.split(None, 1) + [''])[:2]
+      at = float(at)
+      parse_command(command)
+    except ValueError as error:
+      raise ValueError(f"line {number}: {line!r}: {error}") from None
+    script.append((at, command))
+  return script
+
+
+def send_command(socket_path, command, timeout=5.0):
+  """Send one command to a running Runner, returns its decoded reply"""
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.settimeout(timeout)
+    client.connect(socket_path)
+    client.sendall((command.strip() + '\n').encode())
+    reply = client.makefile('rb').readline()
+  return json.loads(reply)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run experiments without a GUI")
+  parser.add_argument("runs", nargs='*', metavar="PORT,EXPERIMENT[,name=value...]",
+                      help=f"experiments: {', '.join(EXPERIMENTS)} (step_time=inf leaves the ff phases to commands)")
+  parser.add_argument("--directory", default="PID_tests")
+  parser.add_argument("--script", type=argparse.FileType(), help="file of 'SECONDS COMMAND' lines")
+  parser.add_argument("--at", nargs=2, action='append', default=[], metavar=("SECONDS", "COMMAND"),
+                      help="run COMMAND at SECONDS after the start")
+  parser.add_argument("--socket", help="UNIX socket to take commands on")
+  parser.add_argument("--send", metavar="COMMAND", help="send COMMAND to the runner on --socket and exit")
+  parser.add_argument("--plot", action="store_true", help="show a live plot")
+  parser.add_argument("--telemetry", type=int, metavar="PORT",
+                      help="publish the rows on this localhost TCP port (see telemetry_server.py)")
+  args = parser.parse_args()
+
+  if args.send:
+    print(json.dumps(send_command(args.socket, args.send), indent=1))
+  else:
+    try:
+      script = parse_script(args.script) if args.script else []
+      script += parse_script(f"{at} {command}" for at, command in args.at)
+    except ValueError as error:
+      parser.error(str(error))
+    orchestrator = Orchestrator(parse_run(spec, args.directory) for spec in args.runs)
+    telemetry = TelemetryServer(port=args.telemetry) if args.telemetry is not None else None
+    Runner(orchestrator, script, args.socket, telemetry).run(plot=args.plot)
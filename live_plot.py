@@ -0,0 +1,144 @@
+# Blitted live plotting
+import numpy as np
+
+
+def decimate_minmax(x, y, columns):
+  """Reduce a long trace to its min and max in each of `columns` bins
+
+  Assumes x is sorted and roughly evenly spaced, so equal index bins are
+  equal pixel columns. Keeps the envelope of the trace, so spikes survive.
+  Missed (NaN) readings are skipped; a bin holding only NaN stays a gap.
+  """
+  n = len(x)
+  if columns < 1 or n <= 2 * columns:
+    return x, y
+  per_bin = n // columns
+  binned = y[:columns * per_bin].reshape(columns, per_bin)
+  offsets = np.arange(columns) * per_bin
+  # nanargmin/nanargmax without their ValueError on all-NaN bins, which then pick a NaN
+  missing = np.isnan(binned)
+  lo = offsets + np.argmin(np.where(missing, np.inf, binned), axis=1)
+  hi = offsets + np.argmax(np.where(missing, -np.inf, binned), axis=1)
+  idx = np.sort(np.stack([lo, hi], axis=1), axis=1).ravel()
+  idx = np.concatenate([idx, np.arange(columns * per_bin, n)])
+  return x[idx], y[idx]
+
+
+def start_timer(fig, callback, interval, frames=None):
+  """Call `callback(i)` every `interval` ms on the figure's event loop
+
+  Unlike FuncAnimation this does not redraw the whole figure after each
+  call, so the callback is free to blit. Stops after `frames` calls.
+  """
+  timer = fig.canvas.new_timer(interval=interval)
+  count = [0]
+
+  def _tick():
+    if frames is not None and count[0] >= frames:
+      timer.stop()
+      return
+    callback(count[0])
+    count[0] += 1
+
+  timer.add_callback(_tick)
+  timer.start()
+  return timer
+
+
+class LiveRenderer:
+  """Blits a set of lines (and other artists) onto a cached background
+
+  The axes limits are only changed, and the figure fully redrawn, when the
+  data leaves the current view. Long traces are decimated to min/max per
+  pixel column of the visible x range before drawing.
+
+  headroom: fraction of the data span added when the view is grown
+  """
+
+  def __init__(self, ax, lines, extra_artists=(), headroom=0.25):
+    self.ax = ax
+    self.fig = ax.figure
+    self.canvas = self.fig.canvas
+    self.lines = list(lines)
+    self.artists = self.lines + list(extra_artists)
+    self.headroom = headroom
+    self.xmin = None
+    self.ylim = None
+    self._x = np.array([])
+    self._ys = [np.array([]) for _ in self.lines]
+    self._background = None
+    self._checked_x = None  # y limits already cover the data up to here
+    for artist in self.artists:
+      artist.set_animated(True)
+    self.canvas.mpl_connect('draw_event', self._on_draw)
+
+  def set_view(self, xmin=None, ylim=None):
+    """Pin the left edge and/or y range of the view, None to autoscale"""
+    self.xmin = xmin
+    self.ylim = ylim
+    self._rescale(force=True)
+    self.canvas.draw_idle()
+
+  def refresh(self, x, ys):
+    """Show new data; x and ys may be (zero-copy) views that keep growing"""
+    self._x = np.asarray(x)
+    self._ys = [np.asarray(y) for y in ys]
+    if self._rescale() or self._background is None:
+      # The draw event handler blits the lines once the new axes are drawn
+      self.canvas.draw_idle()
+      return
+    self.canvas.restore_region(self._background)
+    self._draw_artists()
+    self.canvas.blit(self.fig.bbox)
+
+  def _on_draw(self, event):
+    self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+    self._draw_artists()
+
+  def _draw_artists(self):
+    x = self._x
+    x0, x1 = self.ax.get_xlim()
+    start, stop = np.searchsorted(x, [x0, x1]) if len(x) else (0, 0)
+    start, stop = max(start - 1, 0), min(stop + 1, len(x))
+    columns = int(self.ax.bbox.width)
+    for line, y in zip(self.lines, self._ys):
+      line.set_data(*decimate_minmax(x[start:stop], y[start:stop], columns))
+    for artist in self.artists:
+      self.fig.draw_artist(artist)
+
+  def _rescale(self, force=False):
+    """Grow the view if the data has left it. Returns True if it changed"""
+    x = self._x
+    if not len(x):
+      return False
+    (x0, x1), (y0, y1) = self.ax.get_xlim(), self.ax.get_ylim()
+    changed = False
+
+    new_x0 = x[0] if self.xmin is None else self.xmin
+    if force or x[-1] > x1 or new_x0 != x0:
+      span = max(x[-1] - new_x0, 1.0)
+      self.ax.set_xlim(new_x0, x[-1] + self.headroom * span)
+      changed = True
+
+    if self.ylim is not None:
+      if force or (y0, y1) != tuple(self.ylim):
+        self.ax.set_ylim(*self.ylim)
+        changed = True
+    else:
+      # Only the samples since the last check can have left the y range
+      full = force or self._checked_x is None
+      values = self._values_from(new_x0) if full else self._values_from(self._checked_x, side='right')
+      if len(values) and (full or values.min() < y0 or values.max() > y1):
+        values = values if full else self._values_from(new_x0)
+        lo, hi = values.min(), values.max()
+        pad = self.headroom * max(hi - lo, 1.0)
+        self.ax.set_ylim(lo - pad, hi + pad)
+        changed = True
+    self._checked_x = x[-1]
+    return changed
+
+  def _values_from(self, x_start, side='left'):
+    """Finite y values of all lines from x_start onwards"""
+    start = np.searchsorted(self._x, x_start, side=side)
+    values = np.concatenate([y[start:] for y in self._ys])
+    return values[np.isfinite(values)]
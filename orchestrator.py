@@ -0,0 +1,231 @@
+# Run experiments on several printers at once
+import argparse
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import transport
+import utils
+from control_loop import ControlLoop
+from feedforward import decaying_step_ff
+from run_archive import RunWriter
+from telemetry import TelemetryStore
+
+
+class Experiment:
+  """Headless version of the acquisition scripts: what to send each tick
+
+  Subclasses set `name` and override `setup` and `tick`. `tick` returns the
+  row to record besides 'times' and 'temp'. `phase` and `temp_target` may
+  be changed while the experiment runs (see headless.py).
+  """
+
+  name = 'experiment'
+  columns = ('times', 'temp', 'temp_target')
+
+  def __init__(self, temp_target=200, kp=33, ki=0.04, kd=67.8, timestep=0.5, duration=600.0):
+    self.temp_target = temp_target
+    self.kp, self.ki, self.kd = kp, ki, kd
+    self.timestep = timestep
+    self.duration = duration
+    self.phase = 0
+
+  @property
+  def metadata(self):
+    return dict(experiment=self.name, kp=self.kp, ki=self.ki, kd=self.kd, timestep=self.timestep,
+                temp_target=self.temp_target)
+
+  def setup(self, ser):
+    ser.send(f"M301 P{self.kp} I{self.ki} D{self.kd}")
+    ser.send(f"M104 S{self.temp_target}")
+
+  def tick(self, ser, i, t):
+    # Sent every tick, the CommandBatcher drops it while the target is unchanged
+    ser.send(f"M104 S{self.temp_target}")
+    return dict(temp_target=self.temp_target)
+
+
+class StepResponse(Experiment):
+  """Setpoint step response, as printer_PID_temp.py"""
+
+  name = 'PID_tests'
+
+
+class ExtrusionStep(Experiment):
+  """Extrusion step with the FF law, as PID_with_extrusion_withFF.py (dist_K=0 for no FF)
+
+  Extrudes at feed_rate mm/min in phase 1, which starts at step_time
+  (None to leave the phases to the caller).
+  """
+
+  name = 'EXTRUDE_FF'
+  columns = ('times', 'temp', 'temp_target', 'extrude')
+
+  def __init__(self, dist_K=0, dist_tau=2, dist_T=50, feed_rate=360, step_time=120.0,
+               extrude_feedrate=350, **kwargs):
+    super().__init__(**kwargs)
+    self.dist_K, self.dist_tau, self.dist_T = dist_K, dist_tau, dist_T
+    self.feed_rate = feed_rate
+    self.step_time = step_time
+    self._step_at = step_time
+    self.extrude_feedrate = extrude_feedrate
+    self.feedforward = decaying_step_ff(dist_K, dist_tau, dist_T, self.timestep, feedrate_ref=extrude_feedrate)
+
+  @property
+  def metadata(self):
+    return dict(super().metadata, dist_K=self.dist_K, dist_tau=self.dist_tau, dist_T=self.dist_T,
+                feed_rate=self.feed_rate, step_time=self.step_time)
+
+  def setup(self, ser):
+    super().setup(ser)
+    ser.send("M83")
+
+  def tick(self, ser, i, t):
+    if self._step_at is not None and t >= self._step_at:
+      self.phase, self._step_at = 1, None
+    feed_rate = self.feed_rate if self.phase == 1 else 0
+    ser.send(f"G1 F{feed_rate or self.extrude_feedrate} E{feed_rate * self.timestep / 60:.3f}")
+    target = self.temp_target + self.feedforward.step(feed_rate)
+    ser.send(f"M104 S{target:.3f}")
+    return dict(extrude=feed_rate, temp_target=target)
+
+
+EXPERIMENTS = {'step': StepResponse, 'ff': ExtrusionStep}
+
+
+class PrinterRun:
+  """One printer running one experiment on its own ControlLoop thread
+
+  The printer's temperature request is waited on by its own loop only, so
+  a slow or unresponsive printer delays nothing but itself.
+  """
+
+  def __init__(self, port, experiment: Experiment, directory='PID_tests', baudrate=38400):
+    self.port = port
+    self.experiment = experiment
+    self.directory = directory
+    self.baudrate = baudrate
+    self.ser = None
+    self.batch = None
+    self.data = TelemetryStore(experiment.columns)
+    self.archive = None
+    self.channel = None  # telemetry_server.Channel to publish the rows to
+    self.loop = None
+    self.error = None
+    self.started = None
+    self._request = None
+
+  @property
+  def filestub(self):
+    # The port is in the run metadata: in the name run_catalog would read e.g. ttyUSB0 as a tag
+    return os.path.join(self.directory, f"{self.experiment.name}_{self.started}")
+
+  def connect(self):
+    self.ser = transport.get_serial_transport(port=self.port, baudrate=self.baudrate)
+    return self
+
+  def start(self):
+    self.started = time.time()
+    self.archive = RunWriter(f"{self.filestub}.run", columns=self.data.columns,
+                             metadata=dict(self.experiment.metadata, port=self.port))
+    self.experiment.setup(self.ser)
+    # Each tick's commands go out in one write, unchanged setpoints are not resent
+    self.batch = transport.CommandBatcher(self.ser)
+    self._request = self.ser.request_nozzle_temp()
+    timestep = self.experiment.timestep
+    self.loop = ControlLoop(self._tick, timestep, max_ticks=int(self.experiment.duration / timestep)).start()
+    return self
+
+  def _tick(self, i, t):
+    temp = transport.wait_result(self._request, timeout=self.experiment.timestep)
+    row = self.experiment.tick(self.batch, i, t)
+    self.data.append(times=t, temp=math.nan if temp is None else temp, **row)
+    self.archive.append_last(self.data)
+    if self.channel is not None:
+      self.channel.publish_last(self.data)
+    self._request = self.batch.request_nozzle_temp()
+    self.batch.flush()
+
+  def stop(self, cool=True):
+    if self.loop is not None:
+      self.loop.stop()
+    if self.archive is not None:
+      self.archive.close()
+    if self.ser is not None:
+      utils.close_printer(self.ser, cool=cool)
+
+  def status(self):
+    temp = self.data.last('temp')
+    return dict(port=self.port, experiment=self.experiment.name, ticks=len(self.data),
+                temp=float(temp[0]) if len(temp) else None, running=bool(self.loop and self.loop.running),
+                errors=self.loop.errors if self.loop else 0, error=self.error,
+                suppressed=self.batch.stats['suppressed'] if self.batch else 0)
+
+
+class Orchestrator:
+  """Runs an experiment on each of several printers concurrently"""
+
+  def __init__(self, runs):
+    self.runs = list(runs)
+
+  def connect(self):
+    """Open all printers in parallel (each takes a couple of seconds to reset)"""
+    with ThreadPoolExecutor(max(1, len(self.runs))) as executor:
+      futures = {run: executor.submit(run.connect) for run in self.runs}
+    for run, future in futures.items():
+      if future.exception() is not None:
+        run.error = future.exception()
+        print(f"{run.port}: could not connect: {run.error}")
+    return self
+
+  def start(self):
+    """Start every connected run; one failing to start does not stop the others"""
+    for run in self.runs:
+      if run.error is None:
+        try:
+          run.start()
+        except Exception as error:
+          run.error = error
+          print(f"{run.port}: could not start: {run.error}")
+    return self
+
+  def wait(self, report_every=10.0):
+    """Block until every experiment has finished, printing a status line every report_every s"""
+    while any(run.loop and run.loop.running for run in self.runs):
+      time.sleep(report_every)
+      for status in self.status():
+        print(status)
+
+  def stop(self, cool=True):
+    threads = [threading.Thread(target=run.stop, args=(cool,)) for run in self.runs]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def status(self):
+    return [run.status() for run in self.runs]
+
+
+def parse_run(spec, directory):
+  """'PORT,EXPERIMENT[,name=value...]' -> PrinterRun, e.g. '/dev/ttyUSB0,ff,dist_K=2,dist_tau=2'"""
+  port, kind, *options = spec.split(',')
+  kwargs = {name: float(value) for name, value in (option.split('=', 1) for option in options)}
+  return PrinterRun(port, EXPERIMENTS[kind](**kwargs), directory=directory)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run experiments on several printers at once")
+  parser.add_argument("runs", nargs='+', metavar="PORT,EXPERIMENT[,name=value...]",
+                      help=f"experiments: {', '.join(EXPERIMENTS)}")
+  parser.add_argument("--directory", default="PID_tests")
+  args = parser.parse_args()
+
+  orchestrator = Orchestrator(parse_run(spec, args.directory) for spec in args.runs)
+  try:
+    orchestrator.connect().start().wait()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    orchestrator.stop()
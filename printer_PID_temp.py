@@ -1,17 +1,24 @@
 from asyncio import sleep
+import os
+import threading
 import time
 from cv2 import repeat
 import serial
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
 import utils
-
-com = "COM6"
+import transport
+from telemetry import TelemetryStore
+from live_plot import LiveRenderer, start_timer
+from acquisition import TemperatureFeed
+from run_archive import RunWriter
+from settle import wait_for_temperature
+
+com = os.environ.get("PRINTER_PORT", "COM6")  # e.g. the pty printed by simulator.py
 figname = f"./PID_tests/PID_tests_kp1_{time.time()}"
 
 # Connect to printer
-ser = utils.get_serial_connection(port=com, baudrate=38400)
+ser = transport.get_serial_transport(port=com, baudrate=38400)
 
 # Define initial parameters
 max_start_temp = 25
@@ -25,7 +32,8 @@ ser.write(f"M301 P{kp} I{ki} D{kd}\r\n".encode())
 time.sleep(2)
 
 timestep = 0.5 # seconds
-max_timesteps = 210
+max_timesteps = 210 # seconds
+plot_interval = 1.0  # seconds between plot refreshes
 
 # Setup plot
 fig, ax = plt.subplots()
@@ -34,67 +42,65 @@ target_line, = ax.plot([],[], label="Target Temperature")
 ax.set_ylabel("Nozzle Temp")
 ax.set_xlabel('Time')
 ax.legend()
+renderer = LiveRenderer(ax, [line, target_line])
 
 # Measured variables
-nozzle_temp_data = np.array([])
-time_data = np.array([])
-# target_data = np.array([])
-
-def update(i):
-  global nozzle_temp_data, time_data
-
-  # Read temperature measurement
-  # NOTE: This measurement lags behind by 0.5s (i.e. update interval)
-  nozzle_temp_data = np.append(nozzle_temp_data, [utils.extract_nozzle_temp(ser)])
-  time_data = np.append(time_data, [len(time_data) * timestep])
-  
-  # Replot line
-  line.set_data(time_data, nozzle_temp_data)
-  target_line.set_data(time_data, [temp_target for _ in time_data])
-  ax.autoscale()
-  ax.relim()
-  ax.autoscale_view()
-
-  # Send command to printer to measure temperature
-  ser.write(b'M105\r\n')
+data = TelemetryStore(['times', 'temp'])
+# Samples are also flushed to a run archive as they come in
+archive = RunWriter(f"{figname}.run", columns=data.columns,
+                    metadata=dict(kp=kp, ki=ki, kd=kd, timestep=timestep, temp_target=temp_target))
+archive_lock = threading.Lock()  # Reports are recorded on the reader thread, the archive is closed on this one
+
+def update(t, report):
+  """Record each temperature report as it arrives (serial reader thread)"""
+  if t > max_timesteps:
+    feed.stop()
+    return
+  if report.nozzle is None:
+    return
+  with archive_lock:
+    if archive.closed:  # A report that arrived while stopping
+      return
+    data.append(times=t, temp=report.nozzle)
+    archive.append_last(data)
+
+def stop_recording():
+  """Stop the feed and close the archive, once no report is being recorded"""
+  feed.stop()
+  with archive_lock:
+    archive.close()
+
+def redraw(i):
+  """Replot lines from the data recorded so far"""
+  times, temp = data.views('times', 'temp')
+  renderer.refresh(times, [temp, np.full(len(times), temp_target)])
 
 # Wait until nozzle is cooled down below max_start_temp
 # Initialise printer with commands
 utils.turn_on_fans(ser)
 
-# ser.write(f"M104 S{max_start_temp}\r\n".encode())
 ser.write(b'M104 S0\r\n')
-time.sleep(1)
-temperature = utils.get_nozzle_temp(ser)
-temperature_checkpoints = [i*5 for i in range(int(temperature//5))]
-while True:
-  temperature = utils.get_nozzle_temp(ser)
-  if 10 < temperature < max_start_temp:
-    print(f"Starting Temp: {temperature}")
-    break
-  if temperature < temperature_checkpoints[-1]:
-    print(f"Current temp: {temperature}")
-    temperature_checkpoints.pop()
-  utils.turn_on_fans(ser)
+start_temp = wait_for_temperature(ser, max_start_temp, mode='below', fans=True)
+print(f"Starting Temp: {start_temp}")
 
 
 # Set nozzle target temperature
 ser.write(f"M104 S{temp_target}\r\n".encode())
 time.sleep(2)
 
-# Request temperature measurement
-ser.write(b'M105\r\n')
-ani = animation.FuncAnimation(fig, update, interval=int(timestep*1000), frames=int(max_timesteps/timestep), repeat=False)
+# Temperatures are pushed by the firmware (M155) if it can, else polled every timestep
+feed = TemperatureFeed(ser, interval=timestep, callback=update).start()
+timer = start_timer(fig, redraw, interval=int(plot_interval*1000))
 
 def save_fig(event):
   if event.key == 's':
-    ani.event_source.stop()
+    stop_recording()
+    timer.stop()
     # fig.savefig('test.png')
     plt.savefig(f"{figname}_graph.pdf")
     print(f"Saved fig at: {figname}.pdf")
 
-    np.save(f"{figname}_temp", nozzle_temp_data)
-    np.save(f"{figname}_times", time_data)
+    data.save(figname)
 
     utils.close_printer(ser)
 
@@ -103,5 +109,7 @@ cid = fig.canvas.mpl_connect('key_press_event', save_fig)
 plt.show()
 
 # Closing script
+stop_recording()
+print(f"Temperature reports: {feed.count}")
 utils.close_printer(ser)
 
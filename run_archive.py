@@ -0,0 +1,193 @@
+# Single-file run archive
+import argparse
+import glob
+import json
+import os
+import struct
+import time
+import numpy as np
+from telemetry import RUN_COLUMNS
+
+MAGIC = b'PRINTRUN'
+VERSION = 1
+ALIGN = 64  # Rows start on an aligned offset so the data maps as one array
+EXTENSION = '.run'
+
+
+def _header_bytes(columns, metadata):
+  header = json.dumps(dict(version=VERSION, columns=list(columns), dtype='<f8',
+                           metadata=metadata or {})).encode()
+  prefix = len(MAGIC) + 4
+  padding = -(prefix + len(header)) % ALIGN
+  header += b' ' * padding
+  return MAGIC + struct.pack('<I', len(header)) + header
+
+
+class RunWriter:
+  """Writes samples to a run archive while they are acquired
+
+  File layout: MAGIC, uint32 header length, JSON header (columns and run
+  metadata, e.g. PID gains), then one little-endian float64 record per row.
+  Rows are buffered and appended in chunks every `flush_rows` rows or
+  `flush_interval` s, so a crash loses at most the last chunk; a partly
+  written row at the end of the file is ignored by `RunArchive`.
+  """
+
+  def __init__(self, filename, columns=RUN_COLUMNS, metadata=None, flush_rows=64, flush_interval=1.0,
+               fsync=False):
+    self.filename = filename
+    self.columns = tuple(columns)
+    self.flush_rows = flush_rows
+    self.flush_interval = flush_interval
+    self.fsync = fsync
+    self.rows = 0
+    self._chunk = np.full((flush_rows, len(self.columns)), np.nan)
+    self._buffered = 0
+    self._last_flush = time.monotonic()
+    self._file = open(filename, 'xb')
+    self._file.write(_header_bytes(self.columns, metadata))
+    self._sync()
+
+  def append(self, **values):
+    """Append one row; columns not given are NaN"""
+    row = self._chunk[self._buffered]
+    row[:] = np.nan
+    for i, name in enumerate(self.columns):
+      if name in values:
+        row[i] = values[name]
+    self._buffered += 1
+    self.rows += 1
+    if self._buffered == self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+      self.flush()
+
+  def append_last(self, store):
+    """Append the most recent row of a TelemetryStore"""
+    self.append(**{name: store[name][-1] for name in self.columns if name in store.columns})
+
+  def flush(self):
+    """Write the buffered rows to the file"""
+    if self._buffered:
+      self._file.write(self._chunk[:self._buffered].astype('<f8', copy=False).tobytes())
+      self._buffered = 0
+    self._sync()
+    self._last_flush = time.monotonic()
+
+  @property
+  def closed(self):
+    return self._file.closed
+
+  def close(self):
+    if self._file.closed:
+      return
+    self.fsync = True
+    self.flush()
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def _sync(self):
+    self._file.flush()
+    if self.fsync:
+      os.fsync(self._file.fileno())
+
+
+class RunArchive:
+  """Read-only, memory-mapped view of a run archive
+
+  Columns are zero-copy (strided) views of the file. The archive may still
+  be written to: `refresh` maps the rows that have been flushed since.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, 'rb') as file:
+      if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{filename} is not a run archive")
+      (length,) = struct.unpack('<I', file.read(4))
+      header = json.loads(file.read(length))
+    if header['version'] > VERSION:
+      raise ValueError(f"{filename} has archive version {header['version']}, expected <= {VERSION}")
+    self.columns = tuple(header['columns'])
+    self.metadata = header['metadata']
+    self.dtype = np.dtype(header['dtype'])
+    self._offset = len(MAGIC) + 4 + length
+    self.refresh()
+
+  def refresh(self):
+    """Map all complete rows currently in the file"""
+    row_size = self.dtype.itemsize * len(self.columns)
+    rows = (os.path.getsize(self.filename) - self._offset) // row_size
+    if rows > 0:
+      self._rows = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self._offset,
+                             shape=(rows, len(self.columns)))
+    else:
+      self._rows = np.empty((0, len(self.columns)), dtype=self.dtype)
+    return self
+
+  def __len__(self):
+    return len(self._rows)
+
+  def __getitem__(self, name):
+    return self._rows[:, self.columns.index(name)]
+
+  def __contains__(self, name):
+    return name in self.columns
+
+  def to_dict(self):
+    """Columns as in-memory arrays"""
+    return {name: np.array(self[name]) for name in self.columns}
+
+
+def write_run(filename, columns, metadata=None):
+  """Write a complete run (dict of name -> equal length arrays) to an archive"""
+  names = list(columns)
+  rows = np.column_stack([np.asarray(columns[name], dtype=np.float64) for name in names])
+  with open(filename, 'xb') as file:
+    file.write(_header_bytes(names, metadata))
+    file.write(rows.astype('<f8', copy=False).tobytes())
+
+
+def npy_runs(directory):
+  """Group the f"{filestub}_{name}.npy" files saved by TelemetryStore.save by run
+
+  Returns a dict of filestub -> {name: path}, with names from RUN_COLUMNS.
+  """
+  runs = {}
+  for path in sorted(glob.glob(os.path.join(directory, '*.npy'))):
+    for name in RUN_COLUMNS:
+      if path.endswith(f"_{name}.npy"):
+        runs.setdefault(path[:-len(f"_{name}.npy")], {})[name] = path
+        break
+  return runs
+
+
+def convert_npy_runs(directory, overwrite=False):
+  """Write a run archive next to every run saved as separate .npy files
+
+  Returns the archive filenames written.
+  """
+  written = []
+  for filestub, paths in npy_runs(directory).items():
+    filename = filestub + EXTENSION
+    if os.path.exists(filename):
+      if not overwrite:
+        continue
+      os.remove(filename)
+    columns = {name: np.load(paths[name]) for name in RUN_COLUMNS if name in paths}
+    write_run(filename, columns, metadata=dict(name=os.path.basename(filestub), source='npy'))
+    written.append(filename)
+  return written
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Convert runs saved as .npy files to run archives")
+  parser.add_argument("directory", nargs='?', default="PID_tests")
+  parser.add_argument("--overwrite", action="store_true")
+  args = parser.parse_args()
+
+  for filename in convert_npy_runs(args.directory, overwrite=args.overwrite):
+    print(f"Wrote {filename}")
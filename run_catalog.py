@@ -0,0 +1,179 @@
+# Catalog of the experiment runs in a directory
+import argparse
+import json
+import os
+import re
+import numpy as np
+from run_archive import EXTENSION, RunArchive, npy_runs
+
+INDEX_NAME = '.catalog.json'
+# Filename prefix -> experiment type, longest prefix first
+EXPERIMENTS = (('EXTRUDE_FF', 'ff'), ('EXTRUDE', 'extrude'), ('PID_tests', 'pid'))
+TAG_PATTERN = re.compile(r'^([A-Za-z]+?)(-?\d+(?:\.\d+)?)$')
+TIMESTAMP_PATTERN = re.compile(r'^\d{9,}\.\d+$')
+
+
+def parse_run_name(name):
+  """Experiment type, timestamp and tags from a run name
+
+  'EXTRUDE_FF_k2_tau2_T50_1644410982.1520987' ->
+  {'experiment': 'ff', 'timestamp': 1644410982.15, 'tags': {'k': 2.0, 'tau': 2.0, 'T': 50.0}, 'labels': []}
+  Words that are not <letters><number> (e.g. 'classicPID', 'test') are kept as labels.
+  """
+  experiment, rest = None, name
+  for prefix, kind in EXPERIMENTS:
+    if name == prefix or name.startswith(prefix + '_'):
+      experiment, rest = kind, name[len(prefix):]
+      break
+  words = [word for word in rest.split('_') if word]
+  if experiment is None and words:
+    experiment = words.pop(0).lower()
+  timestamp = None
+  if words and TIMESTAMP_PATTERN.match(words[-1]):
+    timestamp = float(words.pop())
+  tags, labels = {}, []
+  for word in words:
+    match = TAG_PATTERN.match(word)
+    if match:
+      tags[match.group(1)] = float(match.group(2))
+    else:
+      labels.append(word)
+  return dict(experiment=experiment, timestamp=timestamp, tags=tags, labels=labels)
+
+
+class NpyRun:
+  """Lazy view of a run saved as separate .npy files; columns are memory-mapped on first use"""
+
+  def __init__(self, files, metadata=None):
+    self.files = files
+    self.columns = tuple(files)
+    self.metadata = metadata or {}
+    self._arrays = {}
+
+  def __getitem__(self, name):
+    if name not in self._arrays:
+      self._arrays[name] = np.load(self.files[name], mmap_mode='r')
+    return self._arrays[name]
+
+  def __contains__(self, name):
+    return name in self.files
+
+  def __len__(self):
+    return len(self[self.columns[0]]) if self.columns else 0
+
+
+class RunCatalog:
+  """Persistent index of the runs in a directory
+
+  `scan` finds runs saved as .npy files (TelemetryStore.save) and run
+  archives (.run), parses the tags in their names and stores them in
+  `<directory>/.catalog.json`. Only new or modified runs are read again, and
+  then only their headers. Queries run on the index alone; `load` opens the
+  data lazily and memory-mapped.
+  """
+
+  def __init__(self, directory='PID_tests', index=None):
+    self.directory = directory
+    self.index = index or os.path.join(directory, INDEX_NAME)
+    self.runs = {}
+    if os.path.exists(self.index):
+      with open(self.index) as file:
+        self.runs = json.load(file)
+
+  def scan(self):
+    """Update the index with the runs currently in the directory; returns the names that changed"""
+    found = {}
+    for filestub, paths in npy_runs(self.directory).items():
+      found.setdefault(os.path.basename(filestub), {})['npy'] = {name: os.path.basename(path)
+                                                                 for name, path in paths.items()}
+    for filename in os.listdir(self.directory):
+      if filename.endswith(EXTENSION):
+        found.setdefault(filename[:-len(EXTENSION)], {})['archive'] = filename
+
+    changed = [name for name in self.runs if name not in found]
+    for name in changed:
+      del self.runs[name]
+    for name, files in found.items():
+      mtime = max(os.path.getmtime(path) for path in self._paths(files))
+      entry = self.runs.get(name)
+      if entry is not None and entry['files'] == files and entry['mtime'] == mtime:
+        continue
+      self.runs[name] = self._entry(name, files, mtime)
+      changed.append(name)
+    if changed or not os.path.exists(self.index):
+      self.save()
+    return changed
+
+  def save(self):
+    temporary = self.index + '.tmp'
+    with open(temporary, 'w') as file:
+      json.dump(self.runs, file, indent=1, sort_keys=True)
+    os.replace(temporary, self.index)
+
+  def query(self, experiment=None, label=None, sort='timestamp', **tags):
+    """Names of the runs matching all the given values, e.g. query('ff', tau=2)
+
+    Keyword arguments match the tags parsed from the name or, failing that,
+    the metadata stored in a run archive.
+    """
+    names = []
+    for name, entry in self.runs.items():
+      if experiment is not None and entry['experiment'] != experiment:
+        continue
+      if label is not None and label not in entry['labels']:
+        continue
+      values = {**entry['metadata'], **entry['tags']}
+      if all(key in values and values[key] == value for key, value in tags.items()):
+        names.append(name)
+    if sort:
+      names.sort(key=lambda name: (self.runs[name][sort] is None, self.runs[name][sort]))
+    return names
+
+  def load(self, name):
+    """Lazy, memory-mapped columns of a run (the run archive if there is one)"""
+    entry = self.runs[name]
+    files = entry['files']
+    if 'archive' in files:
+      return RunArchive(os.path.join(self.directory, files['archive']))
+    return NpyRun({column: os.path.join(self.directory, filename) for column, filename in files['npy'].items()},
+                  metadata=entry['metadata'])
+
+  def __len__(self):
+    return len(self.runs)
+
+  def __getitem__(self, name):
+    return self.runs[name]
+
+  def _paths(self, files):
+    names = list(files.get('npy', {}).values()) + ([files['archive']] if 'archive' in files else [])
+    return [os.path.join(self.directory, filename) for filename in names]
+
+  def _entry(self, name, files, mtime):
+    entry = parse_run_name(name)
+    metadata = {}
+    if 'archive' in files:
+      archive = RunArchive(os.path.join(self.directory, files['archive']))
+      metadata, rows, columns = archive.metadata, len(archive), list(archive.columns)
+    else:
+      # Only the .npy headers are read
+      arrays = {column: np.load(os.path.join(self.directory, filename), mmap_mode='r')
+                for column, filename in files['npy'].items()}
+      rows, columns = min(len(array) for array in arrays.values()), list(arrays)
+    entry.update(name=name, files=files, mtime=mtime, rows=rows, columns=columns, metadata=metadata)
+    return entry
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Index and query the runs in a directory")
+  parser.add_argument("directory", nargs='?', default="PID_tests")
+  parser.add_argument("--experiment", help="e.g. ff, extrude, pid")
+  parser.add_argument("--label")
+  parser.add_argument("--tag", action="append", default=[], metavar="NAME=VALUE", help="e.g. --tag tau=2")
+  args = parser.parse_args()
+
+  catalog = RunCatalog(args.directory)
+  catalog.scan()
+  tags = {name: float(value) for name, value in (tag.split('=', 1) for tag in args.tag)}
+  for name in catalog.query(args.experiment, label=args.label, **tags):
+    entry = catalog[name]
+    print(f"{name:45s} {entry['experiment']:8s} rows={entry['rows']:5d} {entry['tags']} {entry['labels']}")
@@ -0,0 +1,192 @@
+# Step-response metrics over catalogued runs
+import argparse
+import functools
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from run_catalog import RunCatalog
+from smoothing import reject_outliers
+
+METRICS = ('rise_time', 'overshoot', 'settling_time', 'steady_state_error', 'ise', 'iae',
+           'step_peak_deviation', 'step_mse')
+CACHE_NAME = '.metrics.json'
+CACHE_VERSION = 3  # Bump when the metrics of the same data change
+# Older runs did not record the target; the setpoints used were round numbers (100, 200 C)
+TARGET_RESOLUTION = 50
+MIN_STEP = 5.0  # Smaller setpoint steps have no meaningful rise/settling time / C
+
+
+def pad_rows(arrays):
+  """Stack 1-D arrays of different lengths into a NaN padded 2-D array"""
+  rows = np.full((len(arrays), max((len(array) for array in arrays), default=0)), np.nan)
+  for row, array in zip(rows, arrays):
+    row[:len(array)] = array
+  return rows
+
+
+def _first(mask):
+  # Index of the first True in each row, -1 if there is none
+  return np.where(mask.any(axis=1), np.argmax(mask, axis=1), -1)
+
+
+def _last(mask):
+  # Index of the last True in each row, -1 if there is none
+  return np.where(mask.any(axis=1), mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1), -1)
+
+
+def _take(values, idx):
+  # values[i, idx[i]] for each row, NaN where idx is -1
+  taken = np.take_along_axis(values, np.maximum(idx, 0)[:, None], axis=1)[:, 0]
+  return np.where(idx >= 0, taken, np.nan)
+
+
+def step_metrics(times, temp, target, step_idx, settle_band=0.02, tail=0.1, step_window=100.0):
+  """Metrics for a batch of runs, one row per run (rows NaN padded, see pad_rows)
+
+  times, temp: 2-D arrays / s, C
+  target: setpoint of each run / C
+  step_idx: sample at which the extrusion step starts in each run, -1 if there is none
+  settle_band: settled once within settle_band * |step| of the target
+  tail: fraction of the run at the end over which the steady-state error is averaged
+  step_window: time after the extrusion step over which its deviation is measured / s
+
+  Returns a dict of metric name -> 1-D array. Rise time (10-90 %), overshoot (% of
+  the step) and settling time (from the start) are NaN for runs that start
+  less than MIN_STEP from the target, and the extrusion metrics for runs without a step.
+  """
+  # Missed readings (NaN) can leave gaps anywhere in a row, not only in the padding at its end
+  valid = ~np.isnan(temp)
+  length = _last(valid) + 1  # Up to the last reading
+  target = np.asarray(target, dtype=np.float64)
+  error = temp - target[:, None]
+  start = _take(temp, _first(valid))
+  step = target - start
+  is_step = np.abs(step) >= MIN_STEP
+  scale = np.where(is_step, step, np.nan)
+  elapsed = times - times[:, :1]
+
+  # Setpoint step response
+  with np.errstate(invalid='ignore'):
+    progress = (temp - start[:, None]) / scale[:, None]
+    rise_time = _take(elapsed, _first(progress >= 0.9)) - _take(elapsed, _first(progress >= 0.1))
+    overshoot = np.maximum(np.max(np.where(valid, error / scale[:, None], -np.inf), axis=1), 0.0) * 100
+    outside = valid & (np.abs(error) > settle_band * np.abs(scale)[:, None])
+  last_outside = _last(outside)
+  # Settled at the first reading after the last one outside the band
+  columns = np.arange(temp.shape[1])
+  settled = _first(valid & (columns > last_outside[:, None]))
+  settling_time = np.where(last_outside < 0, 0.0, _take(elapsed, settled))  # NaN if it never settled
+  overshoot[~is_step] = settling_time[~is_step] = np.nan
+
+  # Over the whole run
+  in_tail = valid & (columns >= ((1 - tail) * length)[:, None])
+  steady_state_error = -np.nansum(np.where(in_tail, error, 0.0), axis=1) / np.maximum(in_tail.sum(axis=1), 1)
+  dt = np.diff(times, axis=1)
+  ise = np.nansum(error[:, 1:] ** 2 * dt, axis=1)
+  iae = np.nansum(np.abs(error[:, 1:]) * dt, axis=1)
+
+  # Extrusion step disturbance
+  step_time = _take(times, step_idx)
+  in_window = valid & (times >= step_time[:, None]) & (times < step_time[:, None] + step_window)
+  peak = _first(in_window & (np.abs(error) == np.max(np.where(in_window, np.abs(error), -1), axis=1)[:, None]))
+  step_peak_deviation = _take(error, peak)
+  window_count = in_window.sum(axis=1)
+  step_mse = np.where(window_count > 0, np.sum(np.where(in_window, error ** 2, 0.0), axis=1), np.nan) \
+    / np.maximum(window_count, 1)
+
+  return dict(rise_time=rise_time, overshoot=overshoot, settling_time=settling_time,
+              steady_state_error=steady_state_error, ise=ise, iae=iae,
+              step_peak_deviation=step_peak_deviation, step_mse=step_mse)
+
+
+def run_inputs(run, metadata):
+  """(times, temp, target, extrusion step index) of a loaded run"""
+  times = np.asarray(run['times'], dtype=np.float64)
+  # Missed readings are NaN (0.0 in older runs), and stay NaN where there is nothing to replace them with
+  temp = reject_outliers(np.asarray(run['temp'], dtype=np.float64))
+  if 'temp_target' in metadata:
+    target = metadata['temp_target']
+  elif 'temp_target' in run and len(run['temp_target']):
+    target = run['temp_target'][0]  # The FF adjustments are added on top later
+  else:
+    tail = temp[-max(1, len(temp) // 10):]
+    tail = tail[np.isfinite(tail)]
+    target = round(tail.mean() / TARGET_RESOLUTION) * TARGET_RESOLUTION if len(tail) else np.nan
+  step_idx = -1
+  if 'extrude' in run:
+    extruding = np.flatnonzero(np.asarray(run['extrude']) > 0)
+    step_idx = extruding[0] if len(extruding) else -1
+  return times, temp, float(target), step_idx
+
+
+def analyse_runs(catalog, names, **options):
+  """Metrics of the named runs, computed together; returns name -> {metric: value}"""
+  inputs = [run_inputs(catalog.load(name), catalog[name]['metadata']) for name in names]
+  if not inputs:
+    return {}
+  times, temp, target, step_idx = zip(*inputs)
+  metrics = step_metrics(pad_rows(times), pad_rows(temp), np.array(target), np.array(step_idx), **options)
+  return {name: dict(target=target[i], **{metric: float(values[i]) for metric, values in metrics.items()})
+          for i, name in enumerate(names)}
+
+
+def run_hash(catalog, name, options):
+  """Key of a run's metrics: the contents of its files and the metric options"""
+  digest = hashlib.sha1(json.dumps(dict(options, cache_version=CACHE_VERSION), sort_keys=True).encode())
+  for path in catalog._paths(catalog[name]['files']):
+    with open(path, 'rb') as file:
+      digest.update(file.read())
+  return digest.hexdigest()
+
+
+def analyse(catalog: RunCatalog, names=None, processes=None, batch_size=16, use_cache=True, **options):
+  """Metrics of every run in the catalog (or the given names)
+
+  Runs are analysed in batches of batch_size, one vectorised step_metrics
+  call per batch, across `processes` worker processes if given. Results
+  are cached in <directory>/.metrics.json keyed by run contents and options.
+  """
+  names = list(catalog.runs) if names is None else list(names)
+  cache_file = os.path.join(catalog.directory, CACHE_NAME)
+  cache = {}
+  if use_cache and os.path.exists(cache_file):
+    with open(cache_file) as file:
+      cache = json.load(file)
+  keys = {name: run_hash(catalog, name, options) for name in names}
+  todo = [name for name in names if keys[name] not in cache]
+  batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+  if processes and len(batches) > 1:
+    with ProcessPoolExecutor(processes) as executor:
+      results = list(executor.map(functools.partial(analyse_runs, catalog, **options), batches))
+  else:
+    results = [analyse_runs(catalog, batch, **options) for batch in batches]
+  for result in results:
+    for name, metrics in result.items():
+      cache[keys[name]] = metrics
+  if use_cache and todo:
+    temporary = cache_file + '.tmp'
+    with open(temporary, 'w') as file:
+      json.dump(cache, file)
+    os.replace(temporary, cache_file)
+  return {name: cache[keys[name]] for name in names}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Step-response metrics of every run in a directory")
+  parser.add_argument("directory", nargs='?', default="PID_tests")
+  parser.add_argument("--experiment", help="e.g. ff, extrude, pid")
+  parser.add_argument("--sort", default="timestamp", help="catalog field or metric to sort by")
+  parser.add_argument("--processes", type=int, default=None)
+  args = parser.parse_args()
+
+  catalog = RunCatalog(args.directory)
+  catalog.scan()
+  names = catalog.query(args.experiment, sort=None if args.sort in METRICS else args.sort)
+  results = analyse(catalog, names, processes=args.processes)
+  if args.sort in METRICS:
+    names.sort(key=lambda name: (np.isnan(results[name][args.sort]), results[name][args.sort]))
+  print(f"{'run':45s} " + " ".join(f"{metric:>10.10s}" for metric in METRICS))
+  for name in names:
+    print(f"{name:45s} " + " ".join(f"{results[name][metric]:10.3g}" for metric in METRICS))
@@ -0,0 +1,256 @@
+# Waiting for the nozzle to reach a temperature
+import collections
+import math
+import time
+import utils
+
+
+class RunningStats:
+  """Mean, variance and linear trend of the last `window` samples, O(1) per sample
+
+  The trend makes `level` (the line fitted through the window, evaluated at
+  the newest sample) keep up with a ramp, where the plain mean lags by half
+  a window.
+  """
+
+  def __init__(self, window=10):
+    self.window = window
+    self._samples = collections.deque(maxlen=window)
+    self._sum = 0.0
+    self._sum_sq = 0.0
+    self._sum_ix = 0.0  # sum of position in window * sample
+
+  def add(self, x):
+    n = len(self._samples)
+    if n == self.window:
+      old = self._samples[0]
+      # Every sample moves one position down, the new one goes in at n - 1
+      self._sum_ix += -(self._sum - old) + (n - 1) * x
+      self._sum -= old
+      self._sum_sq -= old * old
+    else:
+      self._sum_ix += n * x
+    self._samples.append(x)
+    self._sum += x
+    self._sum_sq += x * x
+
+  def __len__(self):
+    return len(self._samples)
+
+  @property
+  def full(self):
+    return len(self._samples) == self.window
+
+  @property
+  def mean(self):
+    return self._sum / len(self._samples) if self._samples else math.nan
+
+  @property
+  def variance(self):
+    n = len(self._samples)
+    if n < 2:
+      return math.nan
+    return max(self._sum_sq - self._sum * self._sum / n, 0.0) / (n - 1)
+
+  @property
+  def std(self):
+    return math.sqrt(self.variance)
+
+  def _trend(self):
+    # Least squares line through the window: slope per sample and residual variance
+    n = len(self._samples)
+    s_jj = n * (n * n - 1) / 12
+    s_jx = self._sum_ix - (n - 1) / 2 * self._sum
+    slope = s_jx / s_jj
+    s_xx = max(self._sum_sq - self._sum * self._sum / n, 0.0)
+    return slope, max(s_xx - slope * s_jx, 0.0) / (n - 2), s_jj
+
+  @property
+  def slope(self):
+    """Change per sample of the line fitted through the window"""
+    return self._trend()[0] if len(self._samples) >= 3 else math.nan
+
+  @property
+  def level(self):
+    """Value of the fitted line at the newest sample"""
+    n = len(self._samples)
+    if n < 3:
+      return self.mean
+    return self.mean + self._trend()[0] * (n - 1) / 2
+
+  @property
+  def level_stderr(self):
+    """Standard error of `level`"""
+    n = len(self._samples)
+    if n < 3:
+      return math.nan
+    _, residual, s_jj = self._trend()
+    return math.sqrt(residual * (1 / n + ((n - 1) / 2) ** 2 / s_jj))
+
+
+class ExponentialApproach:
+  """Online fit of T(t) = T_final + (T_0 - T_final) exp(-t / tau) to samples `period` s apart
+
+  Consecutive samples satisfy T[n+1] = a T[n] + b with a = exp(-period / tau)
+  and b = (1 - a) T_final, so a and b are fitted by recursive least squares
+  with exponential forgetting (O(1) per sample, old data weighs less).
+  """
+
+  def __init__(self, period, forgetting=0.98):
+    self.period = period
+    self.forgetting = forgetting
+    self._last = None
+    self._w = self._x = self._y = self._xx = self._xy = 0.0
+
+  def add(self, x):
+    if self._last is not None:
+      f = self.forgetting
+      self._w = f * self._w + 1
+      self._x = f * self._x + self._last
+      self._y = f * self._y + x
+      self._xx = f * self._xx + self._last * self._last
+      self._xy = f * self._xy + self._last * x
+    self._last = x
+
+  def _coefficients(self):
+    if self._w < 3:
+      return None
+    var = self._xx - self._x * self._x / self._w
+    if var <= 1e-9:
+      return None
+    a = (self._xy - self._x * self._y / self._w) / var
+    b = (self._y - a * self._x) / self._w
+    if not 0 < a < 1:
+      return None  # Not an exponential approach (yet)
+    return a, b
+
+  @property
+  def final(self):
+    """Predicted final temperature, None until the fit is usable"""
+    coefficients = self._coefficients()
+    return None if coefficients is None else coefficients[1] / (1 - coefficients[0])
+
+  @property
+  def tau(self):
+    coefficients = self._coefficients()
+    return None if coefficients is None else -self.period / math.log(coefficients[0])
+
+  def time_to(self, temp):
+    """Predicted seconds until `temp` is reached, inf if the approach never gets there"""
+    final, tau = self.final, self.tau
+    if final is None or self._last is None:
+      return None
+    if (self._last - temp) * (final - temp) > 0:
+      return math.inf  # Settles on the same side of temp
+    if self._last == temp:
+      return 0.0
+    return tau * math.log((self._last - final) / (temp - final))
+
+
+class SettleDetector:
+  """Decides when the temperature has settled
+
+  The current temperature is estimated from the last `window` readings by
+  a fitted line (RunningStats.level), with `confidence` standard errors of
+  margin.
+  mode 'band': the estimate is within `tol` of `target` with the margin to
+  spare, and the final temperature of the fitted approach is within `tol`
+  of it too (i.e. no longer drifting).
+  mode 'below' / 'above': the estimate is below / above `target` by the
+  margin (e.g. cooled down enough to start the next run).
+  """
+
+  def __init__(self, target, tol=0.5, mode='band', window=10, period=0.5, confidence=2.0):
+    self.target = target
+    self.tol = tol
+    self.mode = mode
+    self.confidence = confidence
+    self.stats = RunningStats(window)
+    self.approach = ExponentialApproach(period)
+
+  def add(self, temp):
+    self.stats.add(temp)
+    self.approach.add(temp)
+    return self.settled
+
+  @property
+  def temperature(self):
+    """Current temperature estimate"""
+    return self.stats.level
+
+  @property
+  def settled(self):
+    if not self.stats.full:
+      return False
+    margin = self.confidence * self.stats.level_stderr
+    level = self.stats.level
+    if self.mode == 'below':
+      return level + margin < self.target
+    if self.mode == 'above':
+      return level - margin > self.target
+    if abs(level - self.target) + margin > self.tol:
+      return False
+    # Still drifting towards a different final temperature?
+    final = self.approach.final
+    return final is None or abs(final - level) <= self.tol
+
+  def eta(self):
+    """Predicted seconds until the target (band) is reached: None if unknown, inf if never"""
+    if self.settled:
+      return 0.0
+    goal = self.target
+    if self.mode == 'band' and len(self.stats):
+      # The near edge of the band
+      goal += -self.tol if self.stats.level < self.target else self.tol
+    return self.approach.time_to(goal)
+
+
+def wait_for_temperature(ser, target, tol=0.5, mode='band', period=0.5, window=10, timeout=None,
+                         fans=False, report_every=10.0):
+  """Block until the nozzle temperature settles, reading it every `period` s
+
+  ser: serial.Serial or transport.SerialTransport
+  fans: keep the fans on while waiting (cooldown)
+  Returns the settled mean temperature, or None on timeout.
+  """
+  detector = SettleDetector(target, tol=tol, mode=mode, window=window, period=period)
+  fans and utils.turn_on_fans(ser)
+  start = time.monotonic()
+  next_report = start
+  tick = 0
+  while True:
+    temp = utils.get_nozzle_temp(ser)
+    if math.isfinite(temp):  # NaN means no reading
+      detector.add(temp)
+    now = time.monotonic()
+    if detector.settled:
+      print(f"Settled at {detector.temperature:.2f} after {now - start:.0f}s")
+      return detector.temperature
+    if timeout is not None and now - start > timeout:
+      print(f"Timed out at {detector.temperature:.2f} after {now - start:.0f}s")
+      return None
+    if now >= next_report:
+      eta = detector.eta()
+      if eta is None:
+        eta_text = "unknown"
+      elif math.isinf(eta):
+        eta_text = f"not reached, settling at {detector.approach.final:.1f}"
+      else:
+        eta_text = f"{eta:.0f}s"
+      print(f"Temp: {detector.temperature:.2f}, target {target} ({mode}), predicted time to target: {eta_text}")
+      next_report += report_every
+    tick += 1
+    time.sleep(max(0.0, start + tick * period - time.monotonic()))
+
+
+def set_nozzle_temp(ser, temp=25, avg_num=3, tol=0.5, period=0.5, timeout=None):
+  """Heat up or cool down the nozzle to `temp` and wait until it is stable there
+
+  Replaces utils.set_nozzle_temp, with the same arguments and defaults.
+  avg_num: number of readings averaged (the settle window)
+  Cooling turns the fans on. Returns the settled temperature (None on timeout).
+  """
+  current = utils.get_nozzle_temp(ser)
+  ser.write(f"M104 S{temp}\r\n".encode())
+  return wait_for_temperature(ser, temp, tol=tol, period=period, window=avg_num, timeout=timeout,
+                              fans=current > temp)
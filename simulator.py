@@ -0,0 +1,405 @@
+# Software stand-in for the printer, exposed through a pty
+import argparse
+import collections
+import os
+import re
+import select
+import threading
+import time
+import tty
+import numpy as np
+import utils
+
+PID_MAX = 255
+PID_FUNCTIONAL_RANGE = 10  # Marlin: bang-bang outside this error band
+BLOCK_BUFFER_SIZE = 16     # Marlin planner size
+TEMP_WINDOW = 1            # M109: within this many degrees ...
+TEMP_RESIDENCY_TIME = 10   # ... for this many seconds
+
+
+class ThermalPlant:
+  """Lumped first order model of the hotend
+
+  C dT/dt = P u - (h + h_fan * fan + h_extrude * feed_rate) (T - T_ambient)
+
+  u: heater duty (0-1), fan: fan duty (0-1), feed_rate: filament mm/min
+  The thermistor reads the temperature `sensor_delay` seconds late.
+  """
+
+  def __init__(self, ambient=22.0, heat_capacity=10.0, heater_power=40.0, loss=0.12,
+               fan_loss=0.06, extrude_loss=9e-5, sensor_delay=1.0, noise=0.05, dt=0.05, seed=None):
+    self.ambient = ambient
+    self.heat_capacity = heat_capacity  # J/K
+    self.heater_power = heater_power    # W
+    self.loss = loss                    # W/K
+    self.fan_loss = fan_loss            # W/K at full fan
+    self.extrude_loss = extrude_loss    # W/K per mm/min of filament
+    self.sensor_delay = sensor_delay
+    self.noise = noise
+    self.dt = dt
+    self.temp = ambient
+    self._rng = np.random.default_rng(seed)
+    self._history = collections.deque([ambient], maxlen=max(1, int(round(sensor_delay / dt))) + 1)
+
+  def step(self, heater_duty, fan_duty=0.0, feed_rate=0.0):
+    """Advance the plant by one dt"""
+    conductance = self.loss + self.fan_loss * fan_duty + self.extrude_loss * feed_rate
+    power = self.heater_power * heater_duty - conductance * (self.temp - self.ambient)
+    self.temp += power * self.dt / self.heat_capacity
+    self._history.append(self.temp)
+
+  @property
+  def measured(self):
+    """Delayed, noisy thermistor reading"""
+    return self._history[0] + self.noise * self._rng.standard_normal()
+
+
+class MarlinPID:
+  """Hotend PID as Marlin runs it: bang-bang far from target, derivative on measurement"""
+
+  def __init__(self, kp=15.5, ki=0.13, kd=6.0):
+    self.kp, self.ki, self.kd = kp, ki, kd
+    self.reset()
+
+  def reset(self):
+    self.i_state = 0.0
+    self.last_temp = None
+
+  def update(self, target, temp, dt):
+    """Return heater output in 0..PID_MAX"""
+    if target <= 0:
+      self.reset()
+      return 0
+    error = target - temp
+    d_temp = 0.0 if self.last_temp is None else (temp - self.last_temp) / dt
+    self.last_temp = temp
+    if error > PID_FUNCTIONAL_RANGE:
+      self.i_state = 0.0
+      return PID_MAX
+    if error < -PID_FUNCTIONAL_RANGE:
+      self.i_state = 0.0
+      return 0
+    self.i_state += error * dt
+    if self.ki > 0:
+      self.i_state = min(max(self.i_state, 0.0), PID_MAX / self.ki)
+    output = self.kp * error + self.ki * self.i_state - self.kd * d_temp
+    return min(max(output, 0), PID_MAX)
+
+
+class PrinterSimulator:
+  """Marlin-like printer behind a pty
+
+  Answers M105/M104/M109/M301/M106/M107/G0/G1/G4/G92/M82/M83 and friends,
+  and acks other commands. M155 S<seconds> turns on temperature
+  auto-reports, unless `autoreport` is False (M115 reports the
+  capability). Numbered lines (N123 ...*cs) are checked like Marlin does,
+  with Error/Resend replies on bad checksums or line numbers. Simulated
+  time runs `time_scale` times faster than the wall clock once `start` is
+  called, or can be driven by hand with `advance`.
+  """
+
+  def __init__(self, plant=None, time_scale=1.0, kp=15.5, ki=0.13, kd=6.0, line_error_rate=0.0, seed=None,
+               autoreport=True):
+    self.plant = plant or ThermalPlant()
+    self.pid = MarlinPID(kp, ki, kd)
+    self.time_scale = time_scale
+    self.time = 0.0
+    self._unstepped = 0.0        # Simulated seconds not stepped yet
+    self.target = 0.0
+    self.heater_output = 0
+    self.fan = 0.0
+    self.bed_temp = self.plant.ambient
+    self.bed_target = 0.0
+    self.relative_e = False
+    self.relative_xyz = False
+    self.feed_rate = 1500.0     # Last F word, mm/min
+    self.position = dict(X=0.0, Y=0.0, Z=0.0, E=0.0)
+    self.last_line = 0
+    self.line_error_rate = line_error_rate  # Fraction of numbered lines received corrupted
+    self.autoreport = autoreport
+    self.report_interval = 0    # M155 seconds, 0 = off
+    self._next_report = 0.0
+    self._rng = np.random.default_rng(seed)
+    self._planner = collections.deque()  # [seconds remaining, filament mm/min]
+    self._commands = collections.deque()
+    self._wait = None                    # Callable, True once the blocking command is done
+    self._rx = bytearray()
+    self._lock = threading.RLock()
+    self._stop = threading.Event()
+    self._thread = None
+    self._master, self._slave = os.openpty()
+    tty.setraw(self._slave)
+
+  @property
+  def port(self):
+    """Device path to open with serial.Serial / utils.get_serial_connection"""
+    return os.ttyname(self._slave)
+
+  @property
+  def extrusion_rate(self):
+    """Filament feed rate (mm/min) of the move currently executing"""
+    return self._planner[0][1] if self._planner else 0.0
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name="printer-simulator", daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    self._thread and self._thread.join(timeout=1.0)
+    os.close(self._master)
+    os.close(self._slave)
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def advance(self, seconds):
+    """Run the printer for `seconds` of simulated time"""
+    with self._lock:
+      dt = self.plant.dt
+      # Carry the part of a step left over, or short calls would never move time on
+      self._unstepped += seconds
+      steps = int(self._unstepped / dt + 1e-9)
+      self._unstepped -= steps * dt
+      for _ in range(steps):
+        self._step(dt)
+
+  def _run(self):
+    last = time.monotonic()
+    while not self._stop.is_set():
+      ready, _, _ = select.select([self._master], [], [], 0.005)
+      if ready:
+        try:
+          self.receive(os.read(self._master, 4096))
+        except OSError:
+          break
+      now = time.monotonic()
+      self.advance((now - last) * self.time_scale)
+      last = now
+
+  def receive(self, data: bytes):
+    """Feed bytes from the host"""
+    with self._lock:
+      self._rx += data
+      *lines, rest = self._rx.replace(b'\r', b'\n').split(b'\n')
+      self._rx = bytearray(rest)
+      for line in lines:
+        command = self._check_line(line.decode(errors='replace').strip())
+        if command:
+          self._commands.append(command)
+      self._service()
+
+  def _check_line(self, line):
+    """Marlin's line number and checksum checks. Returns the command, or None if rejected"""
+    if not line.startswith('N'):
+      if line.upper().startswith('M110'):
+        match = re.search(r'N(-?\d+)', line[4:])
+        self.last_line = int(match.group(1)) if match else 0
+      return line
+    match = re.fullmatch(r'N(-?\d+)\s*(.*?)\s*(?:\*(\d+))?', line)
+    if match is None:
+      return line
+    number, command, checksum = int(match.group(1)), match.group(2), match.group(3)
+    is_m110 = command.upper().startswith('M110')
+    if checksum is None:
+      error = "No Checksum with line number"
+    elif int(checksum) != utils.gcode_checksum(line[:line.rindex('*')]) or self._rng.random() < self.line_error_rate:
+      error = "checksum mismatch"
+    elif number != self.last_line + 1 and not is_m110:
+      error = "Line Number is not Last Line Number+1"
+    else:
+      self.last_line = number
+      if is_m110:
+        new_number = re.search(r'N(-?\d+)', command[4:])
+        self.last_line = int(new_number.group(1)) if new_number else number
+      return command
+    self._send(f"Error:{error}, Last Line: {self.last_line}")
+    self._send(f"Resend: {self.last_line + 1}")
+    self._send('ok')
+    return None
+
+  def _send(self, text):
+    os.write(self._master, (text + '\n').encode())
+
+  def _step(self, dt):
+    self.time += dt
+    if self._planner:
+      self._planner[0][0] -= dt
+      if self._planner[0][0] <= 0:
+        self._planner.popleft()
+    self.heater_output = self.pid.update(self.target, self.plant.measured, dt)
+    self.plant.step(self.heater_output / PID_MAX, self.fan, self.extrusion_rate)
+    bed_goal = self.bed_target or self.plant.ambient
+    self.bed_temp += (bed_goal - self.bed_temp) * dt / 60
+    if self.report_interval and self.time >= self._next_report:
+      self._send(' ' + self._temperature_report())
+      self._next_report += self.report_interval
+    self._service()
+
+  def _service(self):
+    """Run queued commands until one has to wait"""
+    while True:
+      if self._wait is not None:
+        if not self._wait():
+          return
+        self._wait = None
+        self._send('ok')
+      if not self._commands:
+        return
+      line = self._commands.popleft()
+      if not line:
+        continue
+      reply = self.execute(line)
+      if reply is not None:
+        self._send(reply)
+
+  def _temperature_report(self):
+    return (f"T:{self.plant.measured:.2f} /{self.target:.2f} "
+            f"B:{self.bed_temp:.2f} /{self.bed_target:.2f} @:{int(self.heater_output)} B@:0")
+
+  def execute(self, line):
+    """Execute one command. Returns the reply, or None if the ok is deferred"""
+    line = line.split(';')[0].strip()
+    if not line:
+      return 'ok'
+    code, *words = line.split()
+    code = code.upper()
+    args = {}
+    for word in words:
+      try:
+        args[word[0].upper()] = float(word[1:]) if len(word) > 1 else None
+      except ValueError:
+        pass
+
+    if code == 'M105':
+      return 'ok ' + self._temperature_report()
+    if code == 'M155' and self.autoreport:
+      # Marlin reads the interval as whole seconds
+      self.report_interval = min(int(args.get('S') or 0), 60)
+      self._next_report = self.time + self.report_interval
+      return 'ok'
+    if code == 'M115':
+      self._send("FIRMWARE_NAME:Marlin (simulated) PROTOCOL_VERSION:1.0 EXTRUDER_COUNT:1")
+      self._send(f"Cap:AUTOREPORT_TEMP:{int(self.autoreport)}")
+      return 'ok'
+    if code in ('M104', 'M109'):
+      self.target = args.get('S', args.get('R')) or 0.0
+      if code == 'M109':
+        self._wait = self._heating_wait()
+        return None
+      return 'ok'
+    if code in ('M140', 'M190'):
+      self.bed_target = args.get('S', args.get('R')) or 0.0
+      if code == 'M190':
+        self._wait = lambda: abs(self.bed_temp - self.bed_target) <= TEMP_WINDOW
+        return None
+      return 'ok'
+    if code == 'M301':
+      pid = self.pid
+      pid.kp, pid.ki, pid.kd = args.get('P', pid.kp), args.get('I', pid.ki), args.get('D', pid.kd)
+      self._send(f"echo: p:{pid.kp:.2f} i:{pid.ki:.2f} d:{pid.kd:.2f}")
+      return 'ok'
+    if code == 'M106':
+      speed = args.get('S') if args.get('S') is not None else 255
+      self.fan = min(max(speed / 255, 0.0), 1.0)
+      return 'ok'
+    if code == 'M107':
+      self.fan = 0.0
+      return 'ok'
+    if code in ('M82', 'M83'):
+      self.relative_e = code == 'M83'
+      return 'ok'
+    if code in ('G90', 'G91'):
+      self.relative_xyz = code == 'G91'
+      return 'ok'
+    if code == 'G92':
+      for axis in self.position:
+        if axis in args:
+          self.position[axis] = args[axis] or 0.0
+      return 'ok'
+    if code == 'G28':
+      self.position.update(X=0.0, Y=0.0, Z=0.0)
+      return 'ok'
+    if code in ('G0', 'G1'):
+      return self._move(args)
+    if code == 'G4':
+      seconds = (args.get('S') or 0.0) + (args.get('P') or 0.0) / 1000
+      dwell_end = []
+      def dwell():
+        if self._planner:
+          return False
+        dwell_end or dwell_end.append(self.time + seconds)
+        return self.time >= dwell_end[0]
+      self._wait = dwell
+      return None
+    if code == 'M400':
+      self._wait = lambda: not self._planner
+      return None
+    if re.fullmatch(r'[GMT]\d+', code):
+      return 'ok'
+    self._send(f'echo:Unknown command: "{line}"')
+    return 'ok'
+
+  def _move(self, args):
+    if args.get('F'):
+      self.feed_rate = args['F']
+    delta = {}
+    for axis in self.position:
+      if axis in args and args[axis] is not None:
+        relative = self.relative_xyz or (axis == 'E' and self.relative_e)
+        delta[axis] = args[axis] if relative else args[axis] - self.position[axis]
+        self.position[axis] += delta[axis]
+    distance = np.sqrt(sum(delta.get(axis, 0.0) ** 2 for axis in 'XYZ')) or abs(delta.get('E', 0.0))
+    if distance == 0:
+      return 'ok'
+    duration = distance / (self.feed_rate / 60)
+    filament_rate = max(delta.get('E', 0.0), 0.0) / duration * 60
+    block = [duration, filament_rate]
+    if len(self._planner) < BLOCK_BUFFER_SIZE:
+      self._planner.append(block)
+      return 'ok'
+    # Planner full: hold the ok until a slot frees up, like Marlin
+    def queue_block():
+      if len(self._planner) >= BLOCK_BUFFER_SIZE:
+        return False
+      self._planner.append(block)
+      return True
+    self._wait = queue_block
+    return None
+
+  def _heating_wait(self):
+    """M109: report every second until the nozzle has settled at the target"""
+    state = dict(report=self.time, settled=None)
+    def heating():
+      temp = self.plant.measured
+      if self.time >= state['report']:
+        self._send(f" T:{temp:.2f} E:0 W:?")
+        state['report'] = self.time + 1
+      if abs(temp - self.target) > TEMP_WINDOW:
+        state['settled'] = None
+        return False
+      state['settled'] = state['settled'] if state['settled'] is not None else self.time
+      return self.time - state['settled'] >= TEMP_RESIDENCY_TIME
+    return heating
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run a simulated printer on a pty")
+  parser.add_argument("--time-scale", type=float, default=1.0, help="simulated seconds per wall second")
+  parser.add_argument("--sensor-delay", type=float, default=1.0, help="thermistor delay / s")
+  parser.add_argument("--no-autoreport", action="store_true", help="firmware without M155")
+  args = parser.parse_args()
+
+  simulator = PrinterSimulator(ThermalPlant(sensor_delay=args.sensor_delay), time_scale=args.time_scale,
+                               autoreport=not args.no_autoreport)
+  with simulator:
+    print(f"Simulated printer on: {simulator.port}")
+    try:
+      while True:
+        time.sleep(1)
+    except KeyboardInterrupt:
+      pass
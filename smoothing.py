@@ -0,0 +1,242 @@
+# Streaming and batch smoothing of temperature readings
+import abc
+import collections
+import functools
+import math
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+MAD_SCALE = 1.4826  # Median absolute deviation -> standard deviation for normal noise
+
+
+def _skip_nan(batch):
+  """Batch version of a filter that holds its output over NaN inputs, like `step` does"""
+  @functools.wraps(batch)
+  def wrapper(x, *args, **kwargs):
+    x = np.asarray(x, dtype=np.float64)
+    valid = np.isfinite(x)
+    y = np.full(len(x), np.nan)
+    y[valid] = batch(x[valid], *args, **kwargs)
+    # Forward fill the held values
+    idx = np.maximum.accumulate(np.where(valid, np.arange(len(x)), -1))
+    return np.where(idx >= 0, y[np.maximum(idx, 0)], np.nan)
+  return wrapper
+
+
+@_skip_nan
+def running_mean(x, window):
+  """Mean of the last `window` samples (of all samples so far, before there are that many)"""
+  total = np.cumsum(x)
+  total[window:] = total[window:] - total[:-window]
+  return total / np.minimum(np.arange(1, len(x) + 1), window)
+
+
+@_skip_nan
+def ewma(x, alpha):
+  """Exponentially weighted moving average y[n] = y[n-1] + alpha (x[n] - y[n-1]), y[0] = x[0]"""
+  from scipy.signal import lfilter
+  if not len(x):
+    return x
+  y, _ = lfilter([alpha], [1.0, alpha - 1.0], x[1:], zi=[(1.0 - alpha) * x[0]])
+  return np.concatenate([x[:1], y])
+
+
+def savgol_coefficients(window, order):
+  """Weights of the last `window` samples giving the value at the newest one of a fitted polynomial"""
+  order = min(order, window - 1)
+  positions = np.arange(-(window - 1), 1, dtype=np.float64)
+  return np.linalg.pinv(np.vander(positions, order + 1, increasing=True))[0]
+
+
+@_skip_nan
+def savgol(x, window, order):
+  """Causal Savitzky-Golay: a polynomial of `order` fitted to the last `window` samples, at the newest"""
+  y = np.empty(len(x))
+  for n in range(min(window - 1, len(x))):
+    y[n] = savgol_coefficients(n + 1, order) @ x[:n + 1]
+  if len(x) >= window:
+    y[window - 1:] = sliding_window_view(x, window) @ savgol_coefficients(window, order)
+  return y
+
+
+def reject_outliers(x, window=7, n_sigmas=3.0, min_deviation=2.0, floor=0.0):
+  """Readings replaced by the median of the previous `window` ones when they are invalid or outliers
+
+  Invalid: not finite (a missed reading is NaN) or <= floor (0.0 in older
+  runs). Outlier: further from that median than n_sigmas robust standard
+  deviations (from the MAD), and than min_deviation.
+  NaN where there is nothing to replace an invalid reading with.
+  """
+  x = np.asarray(x, dtype=np.float64)
+  valid = np.isfinite(x) & (x > floor)
+  previous = np.concatenate([np.full(window, np.nan), np.where(valid, x, np.nan)])[:len(x) + window - 1]
+  previous = sliding_window_view(previous, window)
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN windows at the start
+    median = np.nanmedian(previous, axis=1)
+    mad = np.nanmedian(np.abs(previous - median[:, None]), axis=1)
+  limit = np.maximum(n_sigmas * MAD_SCALE * mad, min_deviation)
+  keep = valid & ~(np.abs(x - median) > limit)
+  return np.where(keep, x, median)
+
+
+class StreamingFilter(abc.ABC):
+  """One sample in, one smoothed sample out, at a cost independent of the history length
+
+  `step(x)` returns the new output (also kept in `value`); NaN inputs are
+  skipped and the output held. `batch(x)` gives the outputs for a whole
+  array in one vectorised call, as if it had been stepped through a fresh
+  filter, without touching this filter's state. Subclasses implement
+  `_update` (the new output for a sample) and `batch`.
+  """
+
+  def __init__(self):
+    self.value = math.nan
+
+  def step(self, x):
+    if x == x:  # Not NaN
+      self.value = self._update(x)
+    return self.value
+
+  def reset(self):
+    self.__init__(*self._args)
+
+  @abc.abstractmethod
+  def batch(self, x):
+    """Outputs for the whole array x"""
+
+  @abc.abstractmethod
+  def _update(self, x):
+    """New output for the sample x"""
+
+
+class RunningMean(StreamingFilter):
+  """Mean of the last `window` readings"""
+
+  def __init__(self, window=10):
+    super().__init__()
+    self._args = (window,)
+    self.window = window
+    self._samples = collections.deque(maxlen=window)
+    self._sum = 0.0
+
+  def _update(self, x):
+    if len(self._samples) == self.window:
+      self._sum -= self._samples[0]
+    self._samples.append(x)
+    self._sum += x
+    return self._sum / len(self._samples)
+
+  def batch(self, x):
+    return running_mean(x, self.window)
+
+
+class EWMA(StreamingFilter):
+  """Exponentially weighted moving average; alpha = 1 - exp(-dt / time constant)"""
+
+  def __init__(self, alpha=0.1):
+    super().__init__()
+    self._args = (alpha,)
+    self.alpha = alpha
+
+  @classmethod
+  def from_time_constant(cls, time_constant, dt):
+    return cls(1.0 - math.exp(-dt / time_constant))
+
+  def _update(self, x):
+    if self.value != self.value:
+      return x
+    return self.value + self.alpha * (x - self.value)
+
+  def batch(self, x):
+    return ewma(x, self.alpha)
+
+
+class SavitzkyGolay(StreamingFilter):
+  """Causal Savitzky-Golay filter: a fixed FIR of `window` taps once the window is full"""
+
+  def __init__(self, window=51, order=3):
+    super().__init__()
+    self._args = (window, order)
+    self.window, self.order = window, order
+    self._samples = collections.deque(maxlen=window)
+    self._coefficients = {}  # Samples available -> weights
+
+  def _update(self, x):
+    self._samples.append(x)
+    n = len(self._samples)
+    if n not in self._coefficients:
+      self._coefficients[n] = savgol_coefficients(n, self.order)
+    return float(np.dot(self._coefficients[n], self._samples))
+
+  def batch(self, x):
+    return savgol(x, self.window, self.order)
+
+
+class OutlierFilter(StreamingFilter):
+  """Replaces invalid readings (e.g. the NaN of a missed reply) and spikes, see reject_outliers
+
+  Unlike the other filters it looks at NaN inputs too, as invalid readings.
+  """
+
+  def __init__(self, window=7, n_sigmas=3.0, min_deviation=2.0, floor=0.0):
+    super().__init__()
+    self._args = (window, n_sigmas, min_deviation, floor)
+    self.window, self.n_sigmas, self.min_deviation, self.floor = window, n_sigmas, min_deviation, floor
+    self._samples = collections.deque(maxlen=window)  # Previous readings, NaN if invalid
+    self.rejected = 0
+
+  def step(self, x):
+    self.value = self._update(x)
+    return self.value
+
+  def _update(self, x):
+    valid = math.isfinite(x) and x > self.floor
+    previous = sorted(v for v in self._samples if v == v)
+    self._samples.append(x if valid else math.nan)
+    if not previous:
+      return x if valid else math.nan
+    median = _median(previous)
+    if valid:
+      mad = _median(sorted(abs(v - median) for v in previous))
+      if not abs(x - median) > max(self.n_sigmas * MAD_SCALE * mad, self.min_deviation):
+        return x
+    self.rejected += 1
+    return median
+
+  def batch(self, x):
+    return reject_outliers(x, self.window, self.n_sigmas, self.min_deviation, self.floor)
+
+
+class Chain(StreamingFilter):
+  """Filters applied one after the other, e.g. Chain(OutlierFilter(), RunningMean(10))"""
+
+  def __init__(self, *filters):
+    super().__init__()
+    self._args = filters
+    self.filters = filters
+
+  def step(self, x):
+    self.value = self._update(x)  # NaN goes through too, for filters such as OutlierFilter
+    return self.value
+
+  def _update(self, x):
+    for stage in self.filters:
+      x = stage.step(x)
+    return x
+
+  def reset(self):
+    for stage in self.filters:
+      stage.reset()
+    self.value = math.nan
+
+  def batch(self, x):
+    for stage in self.filters:
+      x = stage.batch(x)
+    return x
+
+
+def _median(ordered):
+  n = len(ordered)
+  return ordered[n // 2] if n % 2 else (ordered[n // 2 - 1] + ordered[n // 2]) / 2
@@ -0,0 +1,226 @@
+# System identification of the hotend from recorded runs
+import argparse
+import itertools
+import numpy as np
+from run_catalog import RunCatalog
+from run_metrics import MIN_STEP, run_inputs
+
+FEEDRATE_REF = 350  # extrude_feedrate the FF law in PID_with_extrusion_withFF.py divides by / mm/min
+
+
+def fopdt_response(t, delay, tau):
+  """Unit step response of K e^(-delay s) / (tau s + 1)"""
+  shifted = np.maximum(t - delay, 0.0)
+  return 1 - np.exp(-shifted / tau)
+
+
+def sopdt_response(t, delay, zeta, wn):
+  """Unit step response of K wn^2 e^(-delay s) / (s^2 + 2 zeta wn s + wn^2), zeta != 1"""
+  shifted = np.maximum(t - delay, 0.0)
+  with np.errstate(invalid='ignore', over='ignore'):
+    # Underdamped
+    wd = wn * np.sqrt(np.abs(1 - zeta ** 2))
+    under = 1 - np.exp(-zeta * wn * shifted) * (np.cos(wd * shifted)
+                                                + zeta * wn / wd * np.sin(wd * shifted))
+    # Overdamped: two real poles
+    p1 = wn * (zeta - np.sqrt(np.abs(zeta ** 2 - 1)))
+    p2 = wn * (zeta + np.sqrt(np.abs(zeta ** 2 - 1)))
+    over = 1 - (p2 * np.exp(-p1 * shifted) - p1 * np.exp(-p2 * shifted)) / (p2 - p1)
+  return np.where(zeta < 1, under, over)
+
+
+def disturbance_response(t, delay, T):
+  """Unit feed rate step response of the FF disturbance model: e^(-t/T) from t = delay on
+
+  This is the shape the FF law in PID_with_extrusion_withFF.py cancels:
+  dist_K * f(t - dist_tau) * exp(-t / dist_T) / FEEDRATE_REF.
+  """
+  return np.where(t >= delay, np.exp(-t / T), 0.0)
+
+
+# Candidate values of the nonlinear parameters of each model / s, rad/s
+FOPDT_GRID = dict(delay=np.arange(0, 30.5, 0.5), tau=np.geomspace(1, 1000, 40))
+SOPDT_GRID = dict(delay=np.arange(0, 20.5, 1.0), zeta=np.r_[np.linspace(0.1, 0.95, 18), np.linspace(1.05, 3, 14)],
+                  wn=np.geomspace(1e-3, 1, 30))
+DISTURBANCE_GRID = dict(delay=np.arange(0, 20.5, 0.5), T=np.geomspace(3, 1000, 40))
+
+
+def resample(times, values, dt):
+  """Values of several runs on a common grid 0, dt, 2dt, ... (NaN past the end of a run)
+
+  Returns the grid (L,) and a 2-D array (runs, L).
+  """
+  length = int(max(np.nanmax(t) for t in times) / dt) + 1
+  grid = np.arange(length) * dt
+  rows = np.full((len(times), length), np.nan)
+  for row, t, y in zip(rows, times, values):
+    row[:] = np.interp(grid, t, y, left=np.nan, right=np.nan)
+  return grid, rows
+
+
+def fit_gains(basis, y, weights):
+  """Batched weighted least squares of y ~ gain * basis for every run and candidate
+
+  basis: (G, L) shared by all runs or (runs, G, L)
+  y, weights: (runs, L)
+  Returns gain and sum of squared errors, each (runs, G).
+  """
+  wy = np.where(weights > 0, weights * y, 0.0)
+  num = np.matmul(basis, wy[:, :, None])[..., 0]
+  den = np.matmul(basis ** 2, weights[:, :, None])[..., 0]
+  gain = num / np.where(den > 0, den, np.inf)
+  sse = np.sum(wy * np.where(weights > 0, y, 0.0), axis=1)[:, None] - gain * num
+  return gain, np.where(np.isfinite(sse), sse, np.inf)
+
+
+def _candidates(grid):
+  # Every combination of the grid values, one array per parameter
+  names = list(grid)
+  combos = np.array(list(itertools.product(*(grid[name] for name in names)))).T
+  return names, combos
+
+
+def fit_model(t, y, weights, response, grid, block=1000, refine=3):
+  """Fit gain * response(t, **params) to many runs at once
+
+  The nonlinear parameters are searched over `grid` (dict of name -> values),
+  `block` candidates at a time, with the gain solved by least squares for
+  each. The best candidate of each run is then refined `refine` times on a
+  5-point grid between its neighbours.
+
+  Returns a dict of name -> (runs,) arrays of the parameters, 'gain' and 'rmse'.
+  """
+  runs = len(y)
+  names, combos = _candidates(grid)
+  best_sse = np.full(runs, np.inf)
+  best = np.zeros((len(names), runs))
+  best_gain = np.zeros(runs)
+  for start in range(0, combos.shape[1], block):
+    chunk = combos[:, start:start + block]
+    basis = response(t, **{name: chunk[i][:, None] for i, name in enumerate(names)})
+    gain, sse = fit_gains(basis, y, weights)
+    idx = np.argmin(sse, axis=1)
+    better = sse[np.arange(runs), idx] < best_sse
+    best_sse = np.where(better, sse[np.arange(runs), idx], best_sse)
+    best_gain = np.where(better, gain[np.arange(runs), idx], best_gain)
+    best[:, better] = chunk[:, idx[better]]
+
+  # Refine between the neighbouring grid values of each run's best candidate
+  low, high = [], []
+  for i, name in enumerate(names):
+    values = np.asarray(grid[name])
+    pos = np.clip(np.searchsorted(values, best[i]), 0, len(values) - 1)
+    low.append(values[np.maximum(pos - 1, 0)])
+    high.append(values[np.minimum(pos + 1, len(values) - 1)])
+  low, high = np.array(low), np.array(high)
+  steps = np.linspace(0, 1, 5)
+  for _ in range(refine):
+    # (params, runs, 5^params) candidates around each run's best
+    axes = [low[i][:, None] + (high[i] - low[i])[:, None] * steps for i in range(len(names))]
+    mesh = np.array([[m.ravel() for m in np.meshgrid(*[a[r] for a in axes], indexing='ij')] for r in range(runs)])
+    mesh = mesh.transpose(1, 0, 2)
+    basis = response(t, **{name: mesh[i][:, :, None] for i, name in enumerate(names)})
+    gain, sse = fit_gains(basis, y, weights)
+    idx = np.argmin(sse, axis=1)
+    sse_best = sse[np.arange(runs), idx]
+    better = sse_best <= best_sse
+    best_sse = np.where(better, sse_best, best_sse)
+    best_gain = np.where(better, gain[np.arange(runs), idx], best_gain)
+    chosen = mesh[:, np.arange(runs), idx]
+    best[:, better] = chosen[:, better]
+    spacing = (high - low) / (len(steps) - 1)
+    low = np.maximum(best - spacing, low)
+    high = np.minimum(best + spacing, high)
+
+  count = np.maximum(np.sum(weights > 0, axis=1), 1)
+  result = {name: best[i] for i, name in enumerate(names)}
+  result.update(gain=best_gain, rmse=np.sqrt(np.maximum(best_sse, 0) / count))
+  return result
+
+
+def setpoint_steps(runs, dt=0.5, horizon=300.0):
+  """Normalised setpoint step responses (temp - start) / (target - start) of runs that start
+  at least MIN_STEP from the target, over `horizon` s or until the extrusion step
+
+  runs: list of (times, temp, target, step_idx) as from run_metrics.run_inputs
+  Returns the indices of the runs used, the time grid and the (runs, L) responses and weights.
+  """
+  used = [i for i, (times, temp, target, _) in enumerate(runs) if abs(target - temp[0]) >= MIN_STEP]
+  times = [runs[i][0] - runs[i][0][0] for i in used]
+  responses = [(runs[i][1] - runs[i][1][0]) / (runs[i][2] - runs[i][1][0]) for i in used]
+  if not used:
+    return used, np.zeros(0), np.zeros((0, 0)), np.zeros((0, 0))
+  t, y = resample(times, responses, dt)
+  end = np.array([min(horizon, runs[i][0][runs[i][3]] - runs[i][0][0] if runs[i][3] >= 0 else np.inf)
+                  for i in used])
+  weights = (~np.isnan(y) & (t[None, :] < end[:, None])).astype(np.float64)
+  return used, t, np.nan_to_num(y), weights
+
+
+def extrusion_steps(runs, extrude, dt=0.5, window=200.0):
+  """Temperature error per unit feed rate, (temp - target) / feed, after each run's extrusion step
+
+  extrude: the feed rate column of each run (None if it has none)
+  Returns the indices of the runs used, the time grid (from the step) and the responses and weights.
+  """
+  used = [i for i, run in enumerate(runs) if run[3] >= 0]
+  times, responses = [], []
+  for i in used:
+    times_i, temp, target, step_idx = runs[i]
+    feed = extrude[i][step_idx]
+    times.append(times_i[step_idx:] - times_i[step_idx])
+    responses.append((temp[step_idx:] - target) / feed)
+  if not used:
+    return used, np.zeros(0), np.zeros((0, 0)), np.zeros((0, 0))
+  t, y = resample(times, responses, dt)
+  weights = (~np.isnan(y) & (t[None, :] < window)).astype(np.float64)
+  return used, t, np.nan_to_num(y), weights
+
+
+def ff_parameters(disturbance, feedrate_ref=FEEDRATE_REF):
+  """FF law parameters (dist_K, dist_tau, dist_T) that cancel fitted disturbances"""
+  return dict(dist_K=-disturbance['gain'] * feedrate_ref, dist_tau=disturbance['delay'], dist_T=disturbance['T'])
+
+
+def identify(catalog: RunCatalog, names=None, dt=0.5):
+  """Fit FOPDT and second order models to the setpoint steps and the disturbance model
+  to the extrusion steps of the catalogued runs
+
+  Returns a dict of model -> (run names, fitted parameters).
+  """
+  names = list(catalog.runs) if names is None else list(names)
+  loaded = [catalog.load(name) for name in names]
+  runs = [run_inputs(run, catalog[name]['metadata']) for run, name in zip(loaded, names)]
+  extrude = [np.asarray(run['extrude']) if 'extrude' in run else None for run in loaded]
+
+  results = {}
+  used, t, y, weights = setpoint_steps(runs, dt)
+  if used:
+    results['fopdt'] = ([names[i] for i in used], fit_model(t, y, weights, fopdt_response, FOPDT_GRID))
+    results['sopdt'] = ([names[i] for i in used], fit_model(t, y, weights, sopdt_response, SOPDT_GRID))
+  used, t, y, weights = extrusion_steps(runs, extrude, dt)
+  if used:
+    results['disturbance'] = ([names[i] for i in used],
+                              fit_model(t, y, weights, disturbance_response, DISTURBANCE_GRID))
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Fit plant and disturbance models to recorded runs")
+  parser.add_argument("directory", nargs='?', default="PID_tests")
+  parser.add_argument("--experiment", help="e.g. ff, extrude, pid")
+  parser.add_argument("--tag", action="append", default=[], metavar="NAME=VALUE",
+                      help="e.g. --tag k=0 for the runs with the FF off")
+  args = parser.parse_args()
+
+  catalog = RunCatalog(args.directory)
+  catalog.scan()
+  tags = {name: float(value) for name, value in (tag.split('=', 1) for tag in args.tag)}
+  results = identify(catalog, catalog.query(args.experiment, **tags))
+  for model, (names, fit) in results.items():
+    print(f"{model}:")
+    for i, name in enumerate(names):
+      print(f"  {name:45s} " + " ".join(f"{key}={values[i]:.4g}" for key, values in fit.items()))
+    if model == 'disturbance':
+      ff = ff_parameters(fit)
+      print("  FF parameters: " + ", ".join(f"{key}={np.median(values):.4g}" for key, values in ff.items()))
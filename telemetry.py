@@ -0,0 +1,100 @@
+# Telemetry store for run samples
+import numpy as np
+
+# Column names double as the suffixes of the saved .npy files
+RUN_COLUMNS = ('times', 'temp', 'temp_target', 'extrude')
+
+
+class TelemetryStore:
+  """Columns of samples on preallocated storage with O(1) appends
+
+  columns: names (stored as float64) or a dict of name -> dtype
+  capacity: initial rows; storage doubles when it fills up
+  window: if given, keep only the last `window` rows in a ring buffer
+
+  Indexing with a column name returns a zero-copy view of the valid rows,
+  oldest first. Views taken before the storage grows keep the old data.
+  In window mode every row is written twice, at i and i + window, so the
+  last `window` rows are always contiguous and can be viewed without a copy.
+  """
+
+  def __init__(self, columns=RUN_COLUMNS, capacity=1024, window=None):
+    if not isinstance(columns, dict):
+      columns = {name: np.float64 for name in columns}
+    self.window = window
+    size = 2 * window if window else max(1, capacity)
+    self._data = {name: np.empty(size, dtype=dtype) for name, dtype in columns.items()}
+    self._count = 0
+
+  @property
+  def columns(self):
+    return tuple(self._data)
+
+  @property
+  def count(self):
+    """Total number of rows appended, including those dropped from the window"""
+    return self._count
+
+  def __len__(self):
+    return min(self._count, self.window) if self.window else self._count
+
+  def __getitem__(self, name):
+    column = self._data[name]
+    if not self.window:
+      return column[:self._count]
+    if self._count <= self.window:
+      return column[:self._count]
+    start = self._count % self.window
+    return column[start:start + self.window]
+
+  def views(self, *names):
+    """Views of several columns with the same number of rows
+
+    Use this when another thread may append between column lookups.
+    """
+    count = self._count
+    if self.window and count > self.window:
+      start = count % self.window
+      return tuple(self._data[name][start:start + self.window] for name in names)
+    return tuple(self._data[name][:count] for name in names)
+
+  def append(self, **values):
+    """Append one row; columns not given are filled with NaN (or 0 for int columns)"""
+    if self.window:
+      rows = (self._count % self.window, self._count % self.window + self.window)
+    else:
+      if self._count == len(next(iter(self._data.values()))):
+        self._grow()
+      rows = (self._count,)
+    for name, column in self._data.items():
+      value = values.get(name, np.nan if column.dtype.kind == 'f' else 0)
+      for row in rows:
+        column[row] = value
+    self._count += 1
+
+  def set_last(self, name, value):
+    """Overwrite a column of the most recent row"""
+    row = self._count - 1
+    if self.window:
+      self._data[name][row % self.window] = value
+      self._data[name][row % self.window + self.window] = value
+    else:
+      self._data[name][row] = value
+
+  def last(self, name, n=1):
+    """View of the last n values of a column"""
+    return self[name][-n:]
+
+  def clear(self):
+    self._count = 0
+
+  def save(self, filestub):
+    """Save each column as f"{filestub}_{name}.npy" """
+    for name in self.columns:
+      np.save(f"{filestub}_{name}", self[name])
+
+  def _grow(self):
+    for name, column in self._data.items():
+      grown = np.empty(2 * len(column), dtype=column.dtype)
+      grown[:self._count] = column[:self._count]
+      self._data[name] = grown
@@ -0,0 +1,210 @@
+# Broadcast live telemetry to local subscribers over TCP
+import argparse
+import json
+import math
+import socket
+import socketserver
+import threading
+import numpy as np
+from telemetry import TelemetryStore
+
+
+class Channel:
+  """Samples of one run in a ring buffer that each subscriber reads at its own pace
+
+  `publish` never waits for a subscriber: subscribers keep a cursor into
+  the ring, and one that falls more than `history` rows behind skips
+  ahead and is told how many rows it lost. The lock is only held to
+  append or copy rows, never while sending.
+  """
+
+  def __init__(self, name, columns, history=10000):
+    self.name = name
+    self.store = TelemetryStore(columns, window=history)
+    self.closed = False
+    self._condition = threading.Condition()
+
+  @property
+  def columns(self):
+    return self.store.columns
+
+  def publish(self, **values):
+    with self._condition:
+      self.store.append(**values)
+      self._condition.notify_all()
+
+  def publish_last(self, store):
+    """Publish the most recent row of a TelemetryStore"""
+    self.publish(**{name: store[name][-1] for name in self.columns if name in store.columns})
+
+  def close(self):
+    with self._condition:
+      self.closed = True
+      self._condition.notify_all()
+
+  def backfill_cursor(self, seconds):
+    """Cursor at the first row of the last `seconds` (by 'times'; all kept rows if negative)"""
+    with self._condition:
+      count = self.store.count
+      if seconds == 0:
+        return count
+      if seconds < 0:
+        return count - len(self.store)
+      if 'times' not in self.columns:
+        return count
+      times = self.store['times']
+      if not len(times):  # Subscribed before the first row
+        return count
+      return count - len(times) + int(np.searchsorted(times, times[-1] - seconds))
+
+  def read(self, cursor, timeout=None):
+    """(rows appended since `cursor` as a 2-D array, new cursor, rows lost), after waiting for one"""
+    with self._condition:
+      self._condition.wait_for(lambda: self.store.count > cursor or self.closed, timeout)
+      count, kept = self.store.count, len(self.store)
+      first = max(cursor, count - kept)
+      views = self.store.views(*self.columns)
+      rows = np.column_stack([view[first - (count - kept):] for view in views])
+    return rows, count, first - cursor
+
+
+class TelemetryServer:
+  """Serves channels to any number of subscribers on a local TCP port
+
+  A subscriber sends one JSON line (an empty line takes the defaults):
+    {"channel": name, "every": n, "interval": s, "backfill": s}
+  every: send every n-th row; interval: at most one row per s of 'times';
+  backfill: start with the rows of the last s seconds (-1: all kept rows).
+  It then receives JSON lines: {"channel": ..., "columns": [...]} first,
+  then one list of values per row, and {"dropped": n} when it fell behind.
+  """
+
+  def __init__(self, host='127.0.0.1', port=0):
+    self.channels = {}
+    server = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        try:
+          server._serve(self.rfile, self.wfile)
+        except (ConnectionError, OSError):
+          pass  # Subscriber went away
+
+    self._server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+    self._server.daemon_threads = True
+    self._server.allow_reuse_address = True
+    self._server.server_bind()
+    self._server.server_activate()
+
+  @property
+  def address(self):
+    return self._server.server_address
+
+  def channel(self, name, columns, history=10000):
+    """New channel to publish to"""
+    self.channels[name] = Channel(name, columns, history)
+    return self.channels[name]
+
+  def start(self):
+    threading.Thread(target=self._server.serve_forever, name="telemetry-server", daemon=True).start()
+    print(f"Telemetry server on {self.address[0]}:{self.address[1]}")
+    return self
+
+  def close(self):
+    for channel in self.channels.values():
+      channel.close()
+    self._server.shutdown()
+    self._server.server_close()
+
+  def _serve(self, rfile, wfile):
+    request = json.loads(rfile.readline().strip() or b'{}')
+    name = request.get('channel')
+    if name is None and len(self.channels) == 1:
+      name = next(iter(self.channels))
+    if name not in self.channels:
+      wfile.write((json.dumps(dict(error=f"no channel {name!r}", channels=list(self.channels))) + '\n').encode())
+      return
+    channel = self.channels[name]
+    every = max(1, int(request.get('every', 1)))
+    interval = float(request.get('interval', 0))
+    time_column = channel.columns.index('times') if 'times' in channel.columns else None
+    wfile.write((json.dumps(dict(channel=name, columns=channel.columns)) + '\n').encode())
+    cursor = channel.backfill_cursor(float(request.get('backfill', 0)))
+    last_bucket = -math.inf
+    while not channel.closed:
+      start = cursor
+      rows, cursor, dropped = channel.read(cursor, timeout=1.0)
+      if not len(rows):
+        continue
+      # Decimation by absolute row number, then by time
+      keep = (np.arange(start + dropped, cursor) % every) == 0
+      if interval > 0 and time_column is not None:
+        bucket = np.floor(rows[:, time_column] / interval)
+        keep &= bucket > np.maximum.accumulate(np.concatenate([[last_bucket], bucket[:-1]]))
+        last_bucket = max(last_bucket, bucket[-1])
+      lines = [json.dumps(dict(dropped=dropped))] if dropped else []
+      lines += [json.dumps([None if value != value else value for value in row]) for row in rows[keep].tolist()]
+      if lines:
+        wfile.write(('\n'.join(lines) + '\n').encode())
+
+
+class Subscriber:
+  """Iterates over the rows (dicts) of a channel of a TelemetryServer
+
+  `dropped` counts the rows the server skipped because this subscriber
+  fell behind.
+  """
+
+  def __init__(self, address, channel=None, every=1, interval=0.0, backfill=0.0, timeout=None):
+    self._file = None
+    self._socket = socket.create_connection(address, timeout=timeout)
+    request = dict(every=every, interval=interval, backfill=backfill)
+    if channel is not None:
+      request['channel'] = channel
+    self._socket.sendall((json.dumps(request) + '\n').encode())
+    self._file = self._socket.makefile('rb')
+    header = json.loads(self._file.readline() or b'{}')
+    if 'columns' not in header:
+      self.close()
+      raise ValueError(header.get('error', "no reply from the telemetry server"))
+    self.channel = header['channel']
+    self.columns = header['columns']
+    self.dropped = 0
+
+  def __iter__(self):
+    for line in self._file:
+      message = json.loads(line)
+      if isinstance(message, dict):
+        self.dropped += message.get('dropped', 0)
+        continue
+      yield dict(zip(self.columns, message))
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+    self._socket.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Print the rows of a telemetry server channel")
+  parser.add_argument("address", help="HOST:PORT")
+  parser.add_argument("--channel")
+  parser.add_argument("--every", type=int, default=1, help="send every n-th row")
+  parser.add_argument("--interval", type=float, default=0.0, help="at most one row per this many seconds")
+  parser.add_argument("--backfill", type=float, default=0.0, help="start with the last this many seconds")
+  args = parser.parse_args()
+
+  host, port = args.address.rsplit(':', 1)
+  try:
+    with Subscriber((host, int(port)), args.channel, args.every, args.interval, args.backfill) as subscriber:
+      print(*subscriber.columns, sep='\t')
+      for row in subscriber:
+        print(*(f"{value:.3f}" if value is not None else "nan" for value in row.values()), sep='\t')
+  except KeyboardInterrupt:
+    pass
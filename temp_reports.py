@@ -0,0 +1,96 @@
+# Parser for Marlin temperature reports (M105 replies and M155 auto-reports)
+import collections
+import re
+
+# 'T:200.00 /200.00', 'T0:...', 'B:60.00 /60.00', '@:127', 'B@:0', '@0:127', ...
+VALUE_PATTERN = re.compile(rb'(?<![A-Za-z@])([TBCPAR]\d*|@\d*|[BC]@)\s*:\s*(-?\d+(?:\.\d*)?)(?:\s*/\s*(-?\d+(?:\.\d*)?))?')
+REPORT_PATTERN = re.compile(rb'(?<![A-Za-z@])[TB]\d*\s*:')  # Lines that should hold a report
+
+# Current and target (None if not reported) of every sensor, heater power (0-127 or 0-255) per heater
+class TemperatureReport(collections.namedtuple('TemperatureReport', ['sensors', 'power', 'line'])):
+  __slots__ = ()
+
+  @property
+  def nozzle(self):
+    """Current temperature of the active hotend ('T', or 'T0'), None if not reported"""
+    value = self.sensors.get('T', self.sensors.get('T0'))
+    return None if value is None else value[0]
+
+# A line that looks like a temperature report but could not be read
+ParseError = collections.namedtuple('ParseError', ['line', 'reason'])
+# An 'Error:' line from the firmware, e.g. MAXTEMP or thermal runaway
+PrinterError = collections.namedtuple('PrinterError', ['line', 'message'])
+
+
+def parse_report(line: bytes):
+  """TemperatureReport, ParseError or PrinterError for one line, None if it is not about temperatures
+
+  ok T:200.00 /200.00 B:60.00 /60.00 @:127 B@:0 ->
+  sensors {'T': (200.0, 200.0), 'B': (60.0, 60.0)}, power {'T': 127.0, 'B': 0.0}
+  '@<n>' and '<heater>@' are the powers of hotend n and of that heater.
+  """
+  if line.startswith(b'Error:'):
+    return PrinterError(line, line[6:].decode(errors='replace').strip())
+  if b':' not in line or REPORT_PATTERN.search(line) is None:
+    return None
+  sensors, power = {}, {}
+  for match in VALUE_PATTERN.finditer(line):
+    name, current, target = match.groups()
+    if b'@' in name:
+      heater = name.replace(b'@', b'')
+      heater = b'T' + heater if not heater or heater.isdigit() else heater
+      power[heater.decode()] = float(current)
+    else:
+      sensors[name.decode()] = (float(current), float(target) if target is not None else None)
+  if not sensors:
+    return ParseError(line, "no temperature values")
+  return TemperatureReport(sensors, power, line)
+
+
+class ReportParser:
+  """Incremental parser of the serial byte stream
+
+  `feed` takes whatever bytes were read, keeps an incomplete last line for
+  the next call, and returns the events of the complete lines (many
+  reports per read are fine).
+  """
+
+  def __init__(self, max_line=1024):
+    self.max_line = max_line
+    self._buffer = bytearray()
+
+  def feed(self, data: bytes):
+    self._buffer += data
+    end = self._buffer.rfind(b'\n')
+    if end < 0:
+      if len(self._buffer) > self.max_line:
+        # No line end in sight: garbage or a wrong baud rate
+        line, self._buffer = bytes(self._buffer), bytearray()
+        return [ParseError(line, "line too long")]
+      return []
+    chunk = bytes(self._buffer[:end])
+    del self._buffer[:end + 1]
+    events = []
+    for line in chunk.split(b'\n'):
+      line = line.strip()
+      if line:
+        event = parse_report(line)
+        if event is not None:
+          events.append(event)
+    return events
+
+
+def parse_lines(text):
+  """Events of all the lines in `text` (bytes or str), e.g. the reply lines of an M105"""
+  if isinstance(text, str):
+    text = text.encode()
+  events = (parse_report(line.strip()) for line in text.splitlines())
+  return [event for event in events if event is not None]
+
+
+def nozzle_temp(events):
+  """Nozzle temperature of the last report among `events`, None if there is none"""
+  for event in reversed(events):
+    if isinstance(event, TemperatureReport) and event.nozzle is not None:
+      return event.nozzle
+  return None
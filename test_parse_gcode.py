@@ -0,0 +1,24 @@
+# Tests for examples/ParseGcode.py (python -m pytest test_parse_gcode.py)
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'examples'))
+import ParseGcode  # noqa: E402
+
+nan = np.nan
+
+
+def test_line_numbers_and_checksums():
+  commands = ParseGcode.parse_gcode(b"M83\nN5 G1 X2 E1*33\nn6 g0 x1 y2*12 ; move\n")
+  np.testing.assert_array_equal(commands, [[1, nan, 2, nan, nan, 1], [0, nan, 1, 2, nan, nan]])
+
+
+def test_compact_words():
+  commands = ParseGcode.parse_gcode(b"M83\nG1X3Y4E5\nG1 X5E-2\n")
+  np.testing.assert_array_equal(commands, [[1, nan, 3, 4, nan, 5], [1, nan, 5, nan, nan, -2]])
+
+
+def test_slicer_exponents():
+  commands = ParseGcode.parse_gcode(b"M83\nG1 X51.189 Y57.853 E3e-05\nG1X3Y4E5e-1\n")
+  np.testing.assert_array_equal(commands, [[1, nan, 51.189, 57.853, nan, 3e-05], [1, nan, 3, 4, nan, 0.5]])
@@ -0,0 +1,54 @@
+# Equivalence of examples/ProcessCommands.py with the original per-command loop (python -m pytest)
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'examples'))
+import ProcessCommands  # noqa: E402
+
+COMMANDS = os.path.join(os.path.dirname(__file__), 'objectdata', 'BenchyBoat.npy')
+
+
+def reference_gcode(commands, kp=15.5, ki=0.13, kd=6.0, nozzletemp=210, bedtemp=55, speedfactor=1,
+                    extrusionfactor=1, retraction=2.5, fanspeed=255):
+  """The loop processgcode used before it was vectorised, body of the file only"""
+  f = ProcessCommands.create_schedules(len(commands), kp=kp, ki=ki, kd=kd, nozzletemp=nozzletemp, bedtemp=bedtemp,
+                                       speedfactor=speedfactor, extrusionfactor=extrusionfactor,
+                                       retraction=retraction, fanspeed=fanspeed)
+  output = ''
+  for i in range(2, len(commands)):
+    commands[i][1] *= f['speedfactor'](i)
+    if commands[i][5] < 0:
+      commands[i][5] = -f['retraction'](i)
+    elif commands[i-1][5] < 0:
+      commands[i][5] = f['retraction'](i)
+    else:
+      commands[i][5] *= f['extrusionfactor'](i)
+    if any(float(f[name](i)) != float(f[name](i-1)) for name in ('kp', 'ki', 'kd')):
+      output += 'M301 P' + str(f['kp'](i)) + ' I' + str(f['ki'](i)) + ' D' + str(f['kd'](i)) + '\n'
+    for name, code in (('nozzletemp', 'M104'), ('bedtemp', 'M140'), ('fanspeed', 'M106')):
+      if float(f[name](i)) != float(f[name](i-1)):
+        output += code + ' S' + str(f[name](i)) + '\n'
+    output += 'G' + str(int(commands[i][0]))
+    for index, prefix in ((2, 'X'), (3, 'Y'), (4, 'Z'), (5, 'E')):
+      output += ProcessCommands.addvariable(commands[i], index, prefix)
+    output += '\n'
+  return output
+
+
+@pytest.mark.parametrize("settings", [
+  dict(),
+  dict(retraction=0),
+  dict(retraction=0, extrusionfactor=0),
+  dict(retraction=1, kp=[10, 20], nozzletemp=[200, 230], speedfactor=[1, 2], fanspeed=[0, 255]),
+])
+@pytest.mark.parametrize("options", [dict(), dict(chunksize=777), dict(chunksize=1000, processes=2)])
+def test_same_gcode_as_loop(settings, options):
+  commands = np.load(COMMANDS)[:5000]
+  expected_commands = commands.copy()
+  expected = reference_gcode(expected_commands, **settings)
+  pieces = list(ProcessCommands.generate_gcode(commands, **settings, **options))
+  assert ''.join(pieces[1:-1]) == expected
+  if not options.get('processes'):  # The process pool works on copies
+    np.testing.assert_array_equal(commands, expected_commands)
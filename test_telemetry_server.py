@@ -0,0 +1,24 @@
+# Tests for telemetry_server (python -m pytest test_telemetry_server.py)
+import itertools
+import telemetry_server
+
+
+def test_backfill_cursor_before_first_row():
+  channel = telemetry_server.Channel('run', ('times', 'temp'))
+  assert channel.backfill_cursor(10.0) == 0
+  channel.publish(times=0.0, temp=20.0)
+  channel.publish(times=1.0, temp=21.0)
+  assert channel.backfill_cursor(0.5) == 1
+
+
+def test_subscribe_with_backfill_before_first_publish():
+  server = telemetry_server.TelemetryServer().start()
+  try:
+    channel = server.channel('run', ('times', 'temp'))
+    with telemetry_server.Subscriber(server.address, backfill=10.0, timeout=5.0) as subscriber:
+      for i in range(3):
+        channel.publish(times=float(i), temp=200.0 + i)
+      rows = list(itertools.islice(subscriber, 3))
+    assert rows == [dict(times=float(i), temp=200.0 + i) for i in range(3)]
+  finally:
+    server.close()
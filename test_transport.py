@@ -0,0 +1,57 @@
+# Tests for transport.CommandBatcher (python -m pytest test_transport.py)
+from concurrent.futures import Future
+import pytest
+import transport
+
+
+class FakeTransport:
+  """Records the writes and acknowledges every command at once"""
+
+  def __init__(self):
+    self.writes = []
+
+  def send_many(self, commands):
+    self.writes.append(list(commands))
+    futures = [Future() for _ in commands]
+    for future in futures:
+      future.set_result(['ok'])
+    return futures
+
+
+@pytest.mark.parametrize("resolution, command, expected", [
+  (1, "M104 S200", "M104 S200"),
+  (1, "M104 S0", "M104 S0"),
+  (1, "M104 S199.6", "M104 S200"),
+  (5, "M104 S203", "M104 S205"),
+  (10, "M104 S100", "M104 S100"),
+  (0.1, "M104 S200.04", "M104 S200"),
+  (0.1, "M104 S205.37", "M104 S205.4"),
+  (0.25, "M104 S200.2", "M104 S200.25"),
+  (0.25, "M104 S200.4", "M104 S200.5"),
+  (0.5, "M104 T0 S210.3", "M104 T0 S210.5"),
+])
+def test_quantise(resolution, command, expected):
+  batcher = transport.CommandBatcher(FakeTransport(), resolution=resolution)
+  assert batcher._quantise(command) == expected
+
+
+def test_unchanged_setpoint_is_dropped():
+  fake = FakeTransport()
+  batcher = transport.CommandBatcher(fake, resolution=1)
+  batcher.send("M104 S200")
+  batcher.flush()
+  assert batcher.send("M104 S200.3").result() == []
+  batcher.send("M104 S201")
+  batcher.flush()
+  assert fake.writes == [["M104 S200"], ["M104 S201"]]
+  assert batcher.stats['suppressed'] == 1
+
+
+def test_bytes_saved_never_negative():
+  batcher = transport.CommandBatcher(FakeTransport(), resolution=0.25)
+  batcher.send("M104 S200.2")  # Sent as S200.25, one byte longer
+  assert batcher.stats['bytes_saved'] == 0
+  batcher.send("M104 S200.3")  # Same setpoint, not sent
+  assert batcher.stats['bytes_saved'] == len("M104 S200.3") + 1
+  batcher.send("M104 S210.0001")  # Sent as S210
+  assert batcher.stats['bytes_saved'] == len("M104 S200.3") + 1 + len(".0001")
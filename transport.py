@@ -0,0 +1,300 @@
+# Event-driven serial transport
+import asyncio
+import collections
+import decimal
+import threading
+from concurrent.futures import CancelledError, Future
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+import serial
+import temp_reports
+import utils
+
+
+class SerialTransport:
+  """Background reader that splits the serial byte stream into lines
+  and pairs each command sent with its `ok` reply.
+
+  Every command returns a Future that resolves to the list of lines
+  received up to and including the `ok`, as soon as the `ok` arrives.
+  Lines that arrive while no command is outstanding (e.g. `echo:` or
+  auto-reported temperatures) are only passed to the listeners.
+
+  The transport mimics the parts of serial.Serial used by utils
+  (`write`, `is_open`, `close`) so it can be passed to those helpers.
+  """
+
+  def __init__(self, ser: serial.Serial, read_timeout=0.05):
+    self.ser = ser
+    self.ser.timeout = read_timeout
+    self._pending = collections.deque()  # (future, reply lines)
+    self._write_lock = threading.Lock()
+    self._listeners = []
+    self._buffer = bytearray()
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._read_loop, name="serial-reader", daemon=True)
+    self._thread.start()
+
+  @property
+  def is_open(self):
+    return self.ser.is_open and not self._stop.is_set()
+
+  def add_listener(self, callback):
+    """Call `callback(line)` from the reader thread for every line received"""
+    self._listeners.append(callback)
+
+  def remove_listener(self, callback):
+    self._listeners.remove(callback)
+
+  def send(self, command: str) -> Future:
+    """Send a single G-code command and return a Future of its reply lines"""
+    return self.send_many([command])[0]
+
+  def send_many(self, commands) -> list:
+    """Send several commands in a single write, returns a Future of each one's reply lines"""
+    futures = [Future() for _ in commands]
+    data = ''.join(command.strip() + '\n' for command in commands).encode()
+    # Queue the futures and write under one lock so replies pair up in order
+    with self._write_lock:
+      for future in futures:
+        self._pending.append((future, []))
+      self.ser.write(data)
+    return futures
+
+  async def send_async(self, command: str):
+    """Awaitable version of `send`"""
+    return await asyncio.wrap_future(self.send(command))
+
+  def write(self, data: bytes):
+    """Drop-in for serial.Serial.write: send each command in `data`"""
+    futures = [self.send(line) for line in data.decode().splitlines() if line.strip()]
+    return futures[-1] if futures else None
+
+  def request_temperatures(self) -> Future:
+    """Send M105 and return a Future of the temp_reports.TemperatureReport (None if not found)"""
+    return _then(self.send('M105'), _last_report)
+
+  def request_nozzle_temp(self) -> Future:
+    """Send M105 and return a Future of the nozzle temperature (None if not found)"""
+    return _then(self.send('M105'), lambda lines: utils.parse_nozzle_temp('\n'.join(lines)))
+
+  def get_nozzle_temp(self, timeout=1.0):
+    """Blocking nozzle temperature read, returns as soon as the reply arrives"""
+    return self.request_nozzle_temp().result(timeout=timeout)
+
+  def close(self):
+    """Stop the reader, cancel outstanding commands and close the port"""
+    self._stop.set()
+    if threading.current_thread() is not self._thread:
+      self._thread.join(timeout=1.0)
+    while self._pending:
+      future, _ = self._pending.popleft()
+      future.cancel()
+    self.ser.close()
+
+  def _read_loop(self):
+    while not self._stop.is_set():
+      try:
+        data = self.ser.read(max(1, self.ser.in_waiting))
+      except (serial.SerialException, OSError, TypeError):
+        # Port closed underneath us
+        break
+      if not data:
+        continue
+      self._buffer += data
+      while True:
+        end = self._buffer.find(b'\n')
+        if end < 0:
+          break
+        line = self._buffer[:end].decode(errors='replace').strip()
+        del self._buffer[:end + 1]
+        if line:
+          self._handle_line(line)
+
+  def _handle_line(self, line: str):
+    for callback in list(self._listeners):  # A listener may remove itself
+      callback(line)
+    if not self._pending:
+      return
+    future, lines = self._pending[0]
+    lines.append(line)
+    if line.startswith('ok'):
+      self._pending.popleft()
+      future.set_running_or_notify_cancel() and future.set_result(lines)
+
+
+# Commands that set state, with the word that selects what they set (hotend, fan, extruder)
+STATE_COMMANDS = {'M104': 'T', 'M106': 'P', 'M301': 'E'}
+# Commands that change that state in other ways: the remembered value is forgotten
+STATE_CHANGES = {'M109': 'M104', 'M107': 'M106'}
+
+
+class CommandBatcher:
+  """Collects the commands of a control tick and sends them in one write
+
+  `send` / `write` queue commands and `flush` writes them all at once.
+  M104, M106 and M301 commands setting the value last acknowledged (or
+  still in flight) are dropped, and M104 setpoints are rounded to
+  `resolution` degrees first, so a target that wanders by less than that
+  costs nothing. Anything else that changes those settings behind the
+  batcher's back (e.g. utils.close_printer) must be followed by
+  `invalidate`.
+
+  Queued commands get a Future straight away; dropped ones resolve to []
+  at once. `stats` counts what was saved.
+  """
+
+  def __init__(self, transport: SerialTransport, resolution=0.1):
+    self.transport = transport
+    self.resolution = resolution
+    # Decimals of the resolution itself, so e.g. 0.25 steps print exactly
+    self._decimals = max(0, -decimal.Decimal(repr(resolution)).normalize().as_tuple().exponent) if resolution else 6
+    self._queue = []      # (command, future, state key, state value)
+    self._state_lock = threading.Lock()  # Replies are handled on the reader thread
+    self._acked = {}      # (code, selector) -> value acknowledged by the printer
+    self._in_flight = {}  # (code, selector) -> value sent, not acknowledged yet
+    self.stats = collections.Counter()
+
+  def send(self, command: str) -> Future:
+    """Queue a command for the next flush, returns a Future of its reply lines"""
+    command = command.split(';')[0].strip()
+    future = Future()
+    if not command:
+      future.set_result([])
+      return future
+    self.stats['commands'] += 1
+    original, command = command, self._quantise(command)
+    with self._state_lock:
+      key, value = self._state(command)
+      redundant = key is not None and value == self._in_flight.get(key, self._acked.get(key))
+      if key is not None and not redundant:
+        self._in_flight[key] = value
+    if redundant:
+      self.stats['suppressed'] += 1
+      self.stats['bytes_saved'] += len(original) + 1
+      future.set_result([])
+      return future
+    # Rounding can also lengthen a setpoint (S200.2 -> S200.25), which saves nothing
+    self.stats['bytes_saved'] += max(0, len(original) - len(command))
+    self._queue.append((command, future, key, value))
+    return future
+
+  def write(self, data: bytes):
+    """Drop-in for serial.Serial.write: queue each command in `data`"""
+    futures = [self.send(line) for line in data.decode().splitlines() if line.strip()]
+    return futures[-1] if futures else None
+
+  def request_nozzle_temp(self) -> Future:
+    """Queue M105, returns a Future of the nozzle temperature (None if not found)"""
+    return _then(self.send('M105'), lambda lines: utils.parse_nozzle_temp('\n'.join(lines)))
+
+  def flush(self):
+    """Send everything queued in a single write"""
+    queue, self._queue = self._queue, []
+    if not queue:
+      return
+    self.stats['writes'] += 1
+    self.stats['writes_saved'] += len(queue) - 1
+    self.stats['bytes_sent'] += sum(len(command) + 1 for command, *_ in queue)
+    replies = self.transport.send_many([command for command, *_ in queue])
+    for reply, (_, future, key, value) in zip(replies, queue):
+      reply.add_done_callback(self._on_reply(future, key, value))
+
+  def invalidate(self):
+    """Forget the printer state, so the next setpoints are sent whatever their value"""
+    with self._state_lock:
+      self._acked.clear()
+      self._in_flight.clear()
+
+  def _on_reply(self, future, key, value):
+    def _done(reply):
+      with self._state_lock:
+        if key is not None and self._in_flight.get(key) == value:
+          del self._in_flight[key]
+          if not reply.cancelled() and reply.exception() is None:
+            self._acked[key] = value
+      if reply.cancelled():
+        future.cancel()
+      elif reply.exception() is not None:
+        future.set_exception(reply.exception())
+      else:
+        future.set_result(reply.result())
+    return _done
+
+  def _quantise(self, command):
+    code, *words = command.split()
+    if code.upper() != 'M104' or not self.resolution:
+      return command
+    for i, word in enumerate(words):
+      if word[:1].upper() == 'S':
+        try:
+          value = round(float(word[1:]) / self.resolution) * self.resolution
+        except ValueError:
+          return command
+        text = f"{value:.{self._decimals}f}"
+        words[i] = 'S' + (text.rstrip('0').rstrip('.') if '.' in text else text)
+    return ' '.join([code, *words])
+
+  def _state(self, command):
+    """(key, value) of a state setting command, (None, None) for others"""
+    code, *words = command.upper().split()
+    if code in STATE_CHANGES:
+      selector = next((word[1:] for word in words if word[:1] == STATE_COMMANDS[STATE_CHANGES[code]]), '')
+      key = (STATE_CHANGES[code], selector)
+      self._acked.pop(key, None)
+      self._in_flight.pop(key, None)
+      return None, None
+    if code not in STATE_COMMANDS:
+      return None, None
+    selector, value = '', []
+    for word in words:
+      if word[:1] == STATE_COMMANDS[code]:
+        selector = word[1:]
+        continue
+      try:
+        value.append((word[0], float(word[1:]) if len(word) > 1 else None))
+      except ValueError:
+        return None, None  # Not understood: always send
+    return (code, selector), tuple(sorted(value))
+
+
+def _then(reply: Future, transform) -> Future:
+  """Future of transform(result of `reply`)"""
+  future = Future()
+
+  def _done(f):
+    if f.cancelled():
+      future.cancel()
+    elif f.exception() is not None:
+      future.set_exception(f.exception())
+    else:
+      future.set_result(transform(f.result()))
+
+  reply.add_done_callback(_done)
+  return future
+
+
+def _last_report(lines):
+  reports = [event for event in temp_reports.parse_lines('\n'.join(lines))
+             if isinstance(event, temp_reports.TemperatureReport)]
+  return reports[-1] if reports else None
+
+
+def wait_result(future: Future, timeout, default=None):
+  """Result of `future`, or `default` if it is not done within `timeout` s"""
+  try:
+    return future.result(timeout=timeout)
+  except (TimeoutError, FuturesTimeoutError, CancelledError):
+    return default
+
+
+def get_serial_transport(port="COM6", baudrate=38400):
+  """Open the printer with utils.get_serial_connection and wrap it in a transport"""
+  return SerialTransport(utils.get_serial_connection(port=port, baudrate=baudrate))
+
+
+if __name__ == "__main__":
+  transport = get_serial_transport()
+  try:
+    print(transport.get_nozzle_temp())
+  finally:
+    utils.close_printer(transport, cool=False)
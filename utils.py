@@ -1,8 +1,10 @@
 # Utils file
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from operator import xor
 import serial
 import time
 import numpy as np
+import temp_reports
 
 def get_serial_connection(port="COM6", baudrate=38400):
   ser = serial.Serial(port=port, baudrate=baudrate)
@@ -16,8 +18,17 @@ def get_serial_connection(port="COM6", baudrate=38400):
 
 def get_nozzle_temp(ser: serial.Serial):
   """Get Nozzle temperature from printer
-  NOTE: this waits 0.2s for the printer to get temperature
+  NOTE: this waits 0.2s for the printer to get temperature,
+  unless ser is a transport.SerialTransport, which returns on the reply.
+  A missed reading is NaN.
   """
+  if hasattr(ser, 'get_nozzle_temp'):
+    try:
+      temp = ser.get_nozzle_temp()
+    except FuturesTimeoutError:  # Busy printer, count it as a missed reading
+      temp = None
+    return np.nan if temp is None else temp
+
   # ser.write(b'\r\n\r\n')
   # time.sleep(2)
   ser.reset_input_buffer()
@@ -34,15 +45,29 @@ def get_nozzle_temp(ser: serial.Serial):
   #   return float(out[colon+1:colon+6])
   # return 0.0
 
+def parse_nozzle_temp(text: str):
+  """Return the nozzle temperature in an M105 reply, or None"""
+  return temp_reports.nozzle_temp(temp_reports.parse_lines(text))
+
+def gcode_checksum(line: str):
+  """Marlin/RepRap line checksum: XOR of all bytes before the '*'"""
+  checksum = 0
+  for byte in line.encode():
+    checksum ^= byte
+  return checksum
+
 def extract_nozzle_temp(ser: serial.Serial):
   """Assuming command has already been sent"""
   out = ser.read(ser.in_waiting)
-  out = str(out)
-  if out != '' and ':' in out and 'S' not in out:
-    colon = out.find('T:') + 1
-    return float(out[colon+1:colon+6])
-  print("Error: No temperature found:\t", out)
-  return 0.0
+  events = temp_reports.parse_lines(out)
+  for event in events:
+    if not isinstance(event, temp_reports.TemperatureReport):
+      print("Error:", event)
+  temp = temp_reports.nozzle_temp(events)
+  if temp is None:
+    print("Error: No temperature found:\t", out)
+    return np.nan
+  return temp
 
 def close_printer(ser: serial.Serial, cool=True):
   """Close printer and cool if high temp"""
@@ -61,55 +86,6 @@ def turn_on_fans(ser: serial.Serial):
   ser.write(b'M42 P4 S255\r\n')
   ser.write(b'M106 S200\r\n')
 
-def set_nozzle_temp(ser: serial.Serial, temp=25, avg_num=3, tol=0.5):
-  """Heat up or cool down nozzle to stable temperature
-  Use cases:
-  Wait for printer nozzle to cool down to a temperature
-  Heat up nozzle to a specific temperature and then monitor
-
-  temp: set temperature
-  avg_num: number of timesteps to average temperature
-  tol: tolerance
-  """
-
-  # Easiest thing to do is to use printer commands
-  # But this mau not work:
-  # ser.write(f"M104 S{temp}\r\n".encode())
-
-  # Initialise array of temperature moving avgs
-  moving_avg_temps = np.array([get_nozzle_temp(ser) for _ in range(avg_num)])
-  avg_temp = np.mean(moving_avg_temps)
-
-  if abs(avg_temp - temp) <= tol:
-    print("Already at required temperature")
-    return True
-
-  # Flag to turn on fan if cooling nozzle
-  flag_cooling = avg_temp > temp
-
-  if avg_temp < temp:   # Heat printer
-    ser.write(f"M104 S{temp}\r\n".encode())
-
-  # Create checkpoints
-  temperature_checkpoints = np.linspace(avg_temp, temp, num=10)
-
-  while abs(moving_avg_temps[-1] - temp) < tol:
-    # Update moving avg
-    # NOTE: circular array implementation will be less memory intense
-    moving_avg_temps = np.append(moving_avg_temps, [get_nozzle_temp(ser)])
-    avg_temp = np.mean(moving_avg_temps[-avg_num:])
-
-    # Pretty neat use of XOR
-    if flag_cooling ^ avg_temp > temperature_checkpoints[-1]:
-        print(f"Moving Avg Temp: {avg_temp}")
-        temperature_checkpoints.pop()
-
-    # Turn on fan if needed
-    flag_cooling and turn_on_fans(ser)
-  
-  # Return
-  print(f"Reached desired tolerance: {avg_temp}")
-
 if __name__ == "__main__":
   ser = get_serial_connection()
   try: